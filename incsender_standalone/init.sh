@@ -30,6 +30,45 @@ echo "SYSLOG_FULL_BODY: Отправка полного тела события
 echo "SYSLOG_SERVER: Адрес принимающего Syslog-сервера"
 echo "SYSLOG_PROTO: Протокол отправки Syslog: tcp / udp"
 echo "SYSLOG_PORT: Порт, на который будут отправлены Syslog-события"
+echo "PAGE_SIZE: Размер страницы при запросе инцидентов из MP10 (инциденты запрашиваются постранично, пока не будут получены все)"
+echo "HTTP_POOL_CONNECTIONS: Количество хостов, для которых держатся пулы keep-alive соединений"
+echo "HTTP_POOL_MAXSIZE: Максимальное количество keep-alive соединений в пуле для одного хоста"
+echo "ENRICH_WORKERS: Количество параллельных запросов данных инцидентов (описания) к MP10"
+echo "INCIDENT_CACHE_SIZE: Максимальное количество инцидентов в кеше данных инцидентов"
+echo "INCIDENT_CACHE_TTL: Время жизни записи в кеше данных инцидентов в секундах"
+echo "FILTER_CHUNK_SIZE: Количество имен правил в одном условии name in (...) / name not in (...) фильтра запроса инцидентов"
+echo "SINK_WORKERS: Количество пачек инцидентов, одновременно отправляемых каждому получателю (Telegram/Mattermost/MS Teams/Syslog), получатели работают параллельно и не ждут друг друга"
+echo "SINK_QUEUE_SIZE: Сколько пачек инцидентов может ожидать отправки самым медленным получателем, пока остальные получатели продолжают отправку (без очереди доставки)"
+echo "SPOOL_PATH: Путь к файлу очереди доставки (SQLite). Инциденты сохраняются в очередь и доставляются каждому получателю независимо, недоставленные отправляются в следующем запуске. Оставьте пустым для отключения"
+echo "OVERLAP_SECONDS: Окно перекрытия в секундах при запросе инцидентов от времени последнего обработанного инцидента, повторы отсеиваются по id"
+echo "SEEN_IDS_MAX: Максимальное количество id обработанных инцидентов, хранимых для отсеивания повторов"
+echo "STATE_PATH: Путь к файлу состояния (время последнего обработанного инцидента и id обработанных инцидентов)"
+echo "TG_MERGE_THRESHOLD: Если в пачке больше инцидентов, чем указано, они объединяются в сообщения Telegram до 4096 символов"
+echo "TG_CHAT_RATE: Максимальное количество сообщений в минуту в чат Telegram"
+echo "SYSLOG_FRAMING: Разделение сообщений Syslog по TCP: lf - переводом строки, octet - с указанием длины сообщения (RFC 6587), приемник должен поддерживать этот формат"
+echo "SYSLOG_TLS: Отправка Syslog по TCP с использованием TLS"
+echo "SYSLOG_TLS_VERIFY: Проверка сертификата Syslog-сервера при использовании TLS"
+echo "SYSLOG_FIELDS_INCLUDE: Поля полного тела инцидента через запятую, которые отправляются по Syslog (например name,severity,assets). Оставьте пустым для отправки всех полей"
+echo "SYSLOG_FIELDS_EXCLUDE: Поля полного тела инцидента через запятую, которые не отправляются по Syslog"
+echo "SCHEDULE_MIN_SECONDS: Минимальный интервал опроса в секундах: пока MP10 возвращает полные страницы инцидентов, интервал сокращается вдвое, но не ниже этого значения"
+echo "SCHEDULE_MAX_SECONDS: Максимальный интервал опроса в секундах: пока новых инцидентов нет, интервал увеличивается вдвое, но не выше этого значения. 0 - не выше SCHEDULE"
+echo "REALTIME_ENABLED: Режим почти реального времени: между запусками каждые REALTIME_INTERVAL секунд запрашивается только последний инцидент, полный запуск выполняется сразу при появлении новых. После неудачного запуска проверка не выполняется до следующего запуска по расписанию"
+echo "REALTIME_INTERVAL: Интервал проверки новых инцидентов в секундах в режиме почти реального времени"
+echo "TARGETS_SETTINGS: Настройки отдельных MP10 при указании нескольких адресов в MP10_ADDRESS через запятую, JSON вида {\"адрес\": {\"first_credential\": {\"login\": \"...\", \"password\": \"...\"}, \"second_credential\": {\"password\": \"...\"}, \"table_list_name\": \"...\"}}. Не указанные параметры берутся из общих настроек"
+echo "METRICS_PORT: Порт HTTP-эндпоинта /metrics с метриками в формате Prometheus (время этапов, количество инцидентов, HTTP-запросы, отставание). 0 - отключено"
+echo "LATENCY_SLO_SECONDS: Допустимая задержка в секундах от создания инцидента в MP10 до доставки получателю, при превышении в лог пишется предупреждение. 0 - отключено"
+echo "LATENCY_WINDOW: Количество последних доставленных инцидентов, по которым считаются перцентили p50/p95/p99 задержки доставки для каждого получателя"
+echo "ENGINE: Режим работы: threads - последовательная обработка пачек инцидентов с пулами потоков; asyncio - конвейер на asyncio, в котором получение токена, выгрузка, обогащение и отправка каждому получателю работают параллельно и связаны ограниченными очередями"
+echo "ASYNC_INFLIGHT: Максимальное количество одновременных запросов в режиме asyncio"
+echo "ASYNC_QUEUE_SIZE: Количество пачек инцидентов в очереди между этапами конвейера в режиме asyncio, при заполнении очереди выгрузка приостанавливается"
+echo "DELIVERY_PROCESSES: Количество процессов, которые форматируют и отправляют инциденты получателям из DELIVERY_PROCESS_SINKS, чтобы использовать все ядра процессора. 0 - отправка в основном процессе"
+echo "DELIVERY_PROCESS_SINKS: Получатели через запятую, отправка которым выполняется процессами DELIVERY_PROCESSES (telegram, mattermost, syslog, teams)"
+echo "DELIVERY_QUEUE_SIZE: Размер очереди заданий для процессов отправки, при заполнении очереди выгрузка приостанавливается. 0 - удвоенное DELIVERY_PROCESSES"
+echo "CYCLE_BUDGET_SECONDS: Бюджет времени одного запуска в секундах: запросы получают оставшееся время как таймаут, но не более четверти бюджета (зависший получатель считается сбоем), и повторяются со случайной задержкой только в его пределах, необработанные инциденты переносятся на следующий запуск. 0 - равен интервалу SCHEDULE"
+echo "CIRCUIT_FAILURE_THRESHOLD: Количество подряд неудачных отправок получателю, после которого отправка ему приостанавливается (сразу завершается ошибкой)"
+echo "CIRCUIT_RESET_SECONDS: Через сколько секунд после приостановки отправки получателю выполняется одна пробная отправка: при успехе отправка возобновляется, при ошибке снова приостанавливается"
+echo "MM_DIGEST_THRESHOLD: Если в пачке больше инцидентов, чем указано, в Mattermost отправляется сводка в виде таблицы, разбитая на сообщения до 16383 символов (без описаний инцидентов). 0 - отключено"
+echo "TEAMS_DIGEST_THRESHOLD: Если в пачке больше инцидентов, чем указано, в MS Teams отправляется сводная карточка с блоком на каждый инцидент, разбитая на сообщения до 28 КБ (без описаний инцидентов). 0 - отключено"
 echo "FIRST_CREDENTIAL_LOGIN: Логин учетной записи MP10"
 echo "FIRST_CREDENTIAL_PASSWORD: Пароль учетной записи MP10"
 echo "SECOND_CREDENTIAL_PASSWORD: Client Secret для доступа к API"
@@ -72,6 +111,45 @@ input_with_default "SYSLOG_FULL_BODY" "$SYSLOG_FULL_BODY"
 input_with_default "SYSLOG_SERVER" "$SYSLOG_SERVER"
 input_with_default "SYSLOG_PROTO" "$SYSLOG_PROTO"
 input_with_default "SYSLOG_PORT" "$SYSLOG_PORT"
+input_with_default "PAGE_SIZE" "$PAGE_SIZE"
+input_with_default "HTTP_POOL_CONNECTIONS" "$HTTP_POOL_CONNECTIONS"
+input_with_default "HTTP_POOL_MAXSIZE" "$HTTP_POOL_MAXSIZE"
+input_with_default "ENRICH_WORKERS" "$ENRICH_WORKERS"
+input_with_default "INCIDENT_CACHE_SIZE" "$INCIDENT_CACHE_SIZE"
+input_with_default "INCIDENT_CACHE_TTL" "$INCIDENT_CACHE_TTL"
+input_with_default "FILTER_CHUNK_SIZE" "$FILTER_CHUNK_SIZE"
+input_with_default "SINK_WORKERS" "$SINK_WORKERS"
+input_with_default "SINK_QUEUE_SIZE" "$SINK_QUEUE_SIZE"
+input_with_default "SPOOL_PATH" "$SPOOL_PATH"
+input_with_default "OVERLAP_SECONDS" "$OVERLAP_SECONDS"
+input_with_default "SEEN_IDS_MAX" "$SEEN_IDS_MAX"
+input_with_default "STATE_PATH" "$STATE_PATH"
+input_with_default "TG_MERGE_THRESHOLD" "$TG_MERGE_THRESHOLD"
+input_with_default "TG_CHAT_RATE" "$TG_CHAT_RATE"
+input_with_default "SYSLOG_FRAMING" "$SYSLOG_FRAMING"
+input_with_default "SYSLOG_TLS" "$SYSLOG_TLS"
+input_with_default "SYSLOG_TLS_VERIFY" "$SYSLOG_TLS_VERIFY"
+input_with_default "SYSLOG_FIELDS_INCLUDE" "$SYSLOG_FIELDS_INCLUDE"
+input_with_default "SYSLOG_FIELDS_EXCLUDE" "$SYSLOG_FIELDS_EXCLUDE"
+input_with_default "SCHEDULE_MIN_SECONDS" "$SCHEDULE_MIN_SECONDS"
+input_with_default "SCHEDULE_MAX_SECONDS" "$SCHEDULE_MAX_SECONDS"
+input_with_default "REALTIME_ENABLED" "$REALTIME_ENABLED"
+input_with_default "REALTIME_INTERVAL" "$REALTIME_INTERVAL"
+input_with_default "TARGETS_SETTINGS" "$TARGETS_SETTINGS"
+input_with_default "METRICS_PORT" "$METRICS_PORT"
+input_with_default "LATENCY_SLO_SECONDS" "$LATENCY_SLO_SECONDS"
+input_with_default "LATENCY_WINDOW" "$LATENCY_WINDOW"
+input_with_default "ENGINE" "$ENGINE"
+input_with_default "ASYNC_INFLIGHT" "$ASYNC_INFLIGHT"
+input_with_default "ASYNC_QUEUE_SIZE" "$ASYNC_QUEUE_SIZE"
+input_with_default "DELIVERY_PROCESSES" "$DELIVERY_PROCESSES"
+input_with_default "DELIVERY_PROCESS_SINKS" "$DELIVERY_PROCESS_SINKS"
+input_with_default "DELIVERY_QUEUE_SIZE" "$DELIVERY_QUEUE_SIZE"
+input_with_default "CYCLE_BUDGET_SECONDS" "$CYCLE_BUDGET_SECONDS"
+input_with_default "CIRCUIT_FAILURE_THRESHOLD" "$CIRCUIT_FAILURE_THRESHOLD"
+input_with_default "CIRCUIT_RESET_SECONDS" "$CIRCUIT_RESET_SECONDS"
+input_with_default "MM_DIGEST_THRESHOLD" "$MM_DIGEST_THRESHOLD"
+input_with_default "TEAMS_DIGEST_THRESHOLD" "$TEAMS_DIGEST_THRESHOLD"
 input_with_default "FIRST_CREDENTIAL_LOGIN" "$FIRST_CREDENTIAL_LOGIN"
 input_with_default "FIRST_CREDENTIAL_PASSWORD" "$FIRST_CREDENTIAL_PASSWORD"
 input_with_default "SECOND_CREDENTIAL_PASSWORD" "$SECOND_CREDENTIAL_PASSWORD"
@@ -96,6 +174,45 @@ SYSLOG_FULL_BODY=${SYSLOG_FULL_BODY}
 SYSLOG_SERVER=${SYSLOG_SERVER}
 SYSLOG_PROTO=${SYSLOG_PROTO}
 SYSLOG_PORT=${SYSLOG_PORT}
+PAGE_SIZE=${PAGE_SIZE}
+HTTP_POOL_CONNECTIONS=${HTTP_POOL_CONNECTIONS}
+HTTP_POOL_MAXSIZE=${HTTP_POOL_MAXSIZE}
+ENRICH_WORKERS=${ENRICH_WORKERS}
+INCIDENT_CACHE_SIZE=${INCIDENT_CACHE_SIZE}
+INCIDENT_CACHE_TTL=${INCIDENT_CACHE_TTL}
+FILTER_CHUNK_SIZE=${FILTER_CHUNK_SIZE}
+SINK_WORKERS=${SINK_WORKERS}
+SINK_QUEUE_SIZE=${SINK_QUEUE_SIZE}
+SPOOL_PATH=${SPOOL_PATH}
+OVERLAP_SECONDS=${OVERLAP_SECONDS}
+SEEN_IDS_MAX=${SEEN_IDS_MAX}
+STATE_PATH=${STATE_PATH}
+TG_MERGE_THRESHOLD=${TG_MERGE_THRESHOLD}
+TG_CHAT_RATE=${TG_CHAT_RATE}
+SYSLOG_FRAMING=${SYSLOG_FRAMING}
+SYSLOG_TLS=${SYSLOG_TLS}
+SYSLOG_TLS_VERIFY=${SYSLOG_TLS_VERIFY}
+SYSLOG_FIELDS_INCLUDE=${SYSLOG_FIELDS_INCLUDE}
+SYSLOG_FIELDS_EXCLUDE=${SYSLOG_FIELDS_EXCLUDE}
+SCHEDULE_MIN_SECONDS=${SCHEDULE_MIN_SECONDS}
+SCHEDULE_MAX_SECONDS=${SCHEDULE_MAX_SECONDS}
+REALTIME_ENABLED=${REALTIME_ENABLED}
+REALTIME_INTERVAL=${REALTIME_INTERVAL}
+TARGETS_SETTINGS=${TARGETS_SETTINGS}
+METRICS_PORT=${METRICS_PORT}
+LATENCY_SLO_SECONDS=${LATENCY_SLO_SECONDS}
+LATENCY_WINDOW=${LATENCY_WINDOW}
+ENGINE=${ENGINE}
+ASYNC_INFLIGHT=${ASYNC_INFLIGHT}
+ASYNC_QUEUE_SIZE=${ASYNC_QUEUE_SIZE}
+DELIVERY_PROCESSES=${DELIVERY_PROCESSES}
+DELIVERY_PROCESS_SINKS=${DELIVERY_PROCESS_SINKS}
+DELIVERY_QUEUE_SIZE=${DELIVERY_QUEUE_SIZE}
+CYCLE_BUDGET_SECONDS=${CYCLE_BUDGET_SECONDS}
+CIRCUIT_FAILURE_THRESHOLD=${CIRCUIT_FAILURE_THRESHOLD}
+CIRCUIT_RESET_SECONDS=${CIRCUIT_RESET_SECONDS}
+MM_DIGEST_THRESHOLD=${MM_DIGEST_THRESHOLD}
+TEAMS_DIGEST_THRESHOLD=${TEAMS_DIGEST_THRESHOLD}
 FIRST_CREDENTIAL_LOGIN=${FIRST_CREDENTIAL_LOGIN}
 FIRST_CREDENTIAL_PASSWORD=${FIRST_CREDENTIAL_PASSWORD}
 SECOND_CREDENTIAL_PASSWORD=${SECOND_CREDENTIAL_PASSWORD}
@@ -1,15 +1,53 @@
 import os
 import datetime
 import json
+import html
 import requests
 import logging
 import socket
+import ssl
 import traceback
-from requests.adapters import HTTPAdapter, Retry
+import itertools
+import concurrent.futures
+import collections
+import threading
+import urllib.parse
+import asyncio
+import contextlib
+import contextvars
+import random
+import http.server
+import sqlite3
+import multiprocessing
+from requests.adapters import HTTPAdapter
 import logging.handlers
 import time
 
-mpToken = None
+mpTokens = {}
+tokenCredentials = {}
+tokenLocks = collections.defaultdict(threading.Lock)
+tokenRefreshers = set()
+httpClient = None
+incidentCache = None
+tableListCache = {}
+sinkExecutors = {}
+telegramBuckets = {}
+syslogConnections = {}
+latencyTrackers = {}
+circuitBreakers = {}
+cycleDeadline = contextvars.ContextVar("cycleDeadline", default=None)
+cycleRequestTimeout = contextvars.ContextVar("cycleRequestTimeout", default=None)
+
+REQUEST_TIMEOUT = 360
+# Share of the run time budget a single HTTP request may take
+REQUEST_BUDGET_SHARE = 0.25
+RETRY_TOTAL = 5
+RETRY_BACKOFF = 1
+RETRY_STATUSES = (502, 503, 504)
+IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "DELETE", "OPTIONS", "TRACE")
+collectStats = {}
+deliverySpool = None
+deliveryPool = None
 
 logging.basicConfig(
     level=logging.INFO,
@@ -21,184 +59,2023 @@ logging.basicConfig(
     ]
 )
 
+class Metrics:
+    # Counters, gauges and histograms exposed in Prometheus text format
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.types = {}
+        self.helps = {}
+        self.values = {}
+        self.histograms = {}
+
+    def describe(self, name, metric_type, help_text):
+        self.types[name] = metric_type
+        self.helps[name] = help_text
+
+    def inc(self, name, labels=None, value=1):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, labels=None, value=0):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            self.values[key] = value
+
+    def observe(self, name, labels=None, value=0):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            histogram = self.histograms.setdefault(
+                key, {"buckets": [0] * len(self.BUCKETS), "sum": 0, "count": 0}
+            )
+            for index, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram["buckets"][index] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, labels=None):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, labels, time.monotonic() - started)
+
+    @staticmethod
+    def format_labels(labels, extra=()):
+        labels = list(labels) + list(extra)
+        if not labels:
+            return ""
+        return "{%s}" % ",".join(
+            '{}="{}"'.format(
+                key,
+                str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+            )
+            for key, value in labels
+        )
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name in sorted(self.types):
+                lines.append(f"# HELP {name} {self.helps[name]}")
+                lines.append(f"# TYPE {name} {self.types[name]}")
+
+                for (metric, labels), value in sorted(self.values.items()):
+                    if metric == name:
+                        lines.append(f"{name}{self.format_labels(labels)} {value}")
+
+                for (metric, labels), histogram in sorted(self.histograms.items()):
+                    if metric != name:
+                        continue
+                    for bound, count in zip(self.BUCKETS, histogram["buckets"]):
+                        lines.append(
+                            f"{name}_bucket{self.format_labels(labels, [('le', bound)])} {count}"
+                        )
+                    lines.append(
+                        f"{name}_bucket{self.format_labels(labels, [('le', '+Inf')])} {histogram['count']}"
+                    )
+                    lines.append(f"{name}_sum{self.format_labels(labels)} {histogram['sum']}")
+                    lines.append(f"{name}_count{self.format_labels(labels)} {histogram['count']}")
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+metrics.describe(
+    "incsender_stage_duration_seconds",
+    "histogram",
+    "Duration of pipeline stages: token, fetch, filter, enrich, render, send",
+)
+metrics.describe(
+    "incsender_incidents_fetched_total", "counter", "Incidents fetched from MP10"
+)
+metrics.describe(
+    "incsender_incidents_filtered_total",
+    "counter",
+    "Incidents dropped by bl/wl filter on the sender side",
+)
+metrics.describe(
+    "incsender_incidents_delivered_total", "counter", "Incidents delivered to output"
+)
+metrics.describe(
+    "incsender_incidents_failed_total", "counter", "Incidents failed to deliver to output"
+)
+metrics.describe(
+    "incsender_http_requests_total", "counter", "HTTP requests by host and status"
+)
+metrics.describe("incsender_http_retries_total", "counter", "HTTP retries by host")
+metrics.describe(
+    "incsender_delivery_latency_seconds",
+    "histogram",
+    "Incident latency by output and stage: fetch (created to fetched), enrich, deliver, total",
+)
+metrics.describe(
+    "incsender_delivery_latency_quantile_seconds",
+    "gauge",
+    "Rolling end-to-end latency quantiles by output",
+)
+metrics.describe(
+    "incsender_latency_slo_breaches_total",
+    "counter",
+    "Incidents delivered later than LATENCY_SLO_SECONDS after creation",
+)
+metrics.describe(
+    "incsender_circuit_state",
+    "gauge",
+    "Circuit breaker state by output: 0 - closed, 1 - half-open, 2 - open",
+)
+metrics.describe(
+    "incsender_circuit_transitions_total",
+    "counter",
+    "Circuit breaker transitions by output and new state",
+)
+metrics.describe(
+    "incsender_watermark_lag_seconds",
+    "gauge",
+    "Time between the last processed incident and the end of the run",
+)
+
+
+def start_metrics_server(port):
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logging.info(f"Metrics available at http://0.0.0.0:{port}/metrics")
+
+
 def run(target, settings):
-    savepoint = None
+    savepoint = load_state(settings["state_path"])
     has_more = True
 
-    while has_more:
-        
-        if os.path.exists("./savepoint"):
-          with open("savepoint", "r") as file:
-            savepoint = file.read()
-        else:
-            savepoint = None
+    start_token_refresher(target)
+
+    # Asyncio engine runs every collect as a pipeline on its own event loop
+    collect_run = collect_async if settings["engine"] == "asyncio" else collect
+
+    # Runs are scheduled on a fixed cadence of monotonic time, so the period
+    # does not drift by the run duration
+    base_interval = int(settings["schedule"]) * 60
+    interval = base_interval
+    next_run = time.monotonic()
+
+    while has_more:
+        scheduled = time.monotonic() >= next_run
+
+        has_more, savepoint = collect_run(target, settings, savepoint)
+
+        save_state(settings["state_path"], savepoint)
+
+        # Runs started by near real-time probe do not move the schedule
+        if scheduled:
+            interval = next_interval(
+                target,
+                interval,
+                base_interval,
+                int(settings["schedule_min_seconds"]),
+                int(settings["schedule_max_seconds"] or base_interval),
+            )
+            next_run += interval
+
+            now = time.monotonic()
+            if next_run < now:
+                logging.info(f"Run took longer than {interval}s, starting next run now")
+                next_run = now
+
+        wait_for_run(target, settings, savepoint, next_run)
+
+
+def run_targets(targets, settings, targets_settings):
+    # Every MP10 core is polled on its own schedule with its own token, state
+    # and filter cache, outputs, spool and HTTP client are shared
+    settings = {
+        **settings,
+        "http_pool_connections": max(
+            int(settings["http_pool_connections"]), len(targets) + 4
+        ),
+    }
+    state_root, state_ext = os.path.splitext(settings["state_path"])
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=len(targets), thread_name_prefix="target"
+    ) as executor:
+        futures = {
+            executor.submit(
+                run,
+                target,
+                {
+                    **settings,
+                    "state_path": f"{state_root}.{target}{state_ext}",
+                    **targets_settings.get(target, {}),
+                },
+            ): target
+            for target in targets
+        }
+
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                logging.error(f"Error while running {futures[future]}: {e}.")
+                logging.error(traceback.format_exc())
+
+
+def wait_for_run(target, settings, savepoint, next_run):
+    # In near real-time mode new incidents are probed every few seconds and
+    # the run is started as soon as they appear. After a failed run the
+    # watermark did not move and the probe would start a run every time,
+    # so the next scheduled run is waited for
+    if not settings["realtime_enabled"] or get_collect_stats(target)["failed"]:
+        time.sleep(max(next_run - time.monotonic(), 0))
+        return
+
+    while True:
+        now = time.monotonic()
+        if now >= next_run:
+            return
+
+        time.sleep(min(int(settings["realtime_interval"]), next_run - now))
+
+        if time.monotonic() >= next_run:
+            return
+
+        try:
+            if probe_new_incidents(target, settings, savepoint):
+                logging.info("New incidents found by probe, starting run")
+                return
+        except Exception as e:
+            logging.error(f"Error while probing incidents: {e}.")
+
+
+def probe_new_incidents(target, settings, savepoint):
+    where = get_collect_stats(target)["where"]
+    if where is None:
+        return False
+
+    # Token is kept fresh by the background refresher, it is requested
+    # here only before the first run got it
+    token = mpTokens.get(target) or obtain_token(
+        target,
+        settings["first_credential"]["login"],
+        settings["first_credential"]["password"],
+        settings["second_credential"]["password"],
+    )
+    state = load_savepoint(savepoint, settings["minutes"])
+
+    newest = probe_incidents(
+        token["access_token"], target, state["watermark"], where
+    )
+
+    return (
+        newest is not None
+        and parse_created(newest["created"]) > state["watermark"]
+        and newest.get("id") not in state["seen"]
+    )
+
+
+def get_collect_stats(target):
+    # Counters of the last run of every MP10 core used by the scheduler
+    return collectStats.setdefault(
+        target,
+        {
+            "processed": 0,
+            "page_size": 50,
+            "backlog": 0,
+            "carried": False,
+            "failed": False,
+            "where": '(status != "Closed")',
+        },
+    )
+
+
+def next_interval(target, interval, base_interval, min_interval, max_interval):
+    # Poll more often while full pages are returned or backlog exists, and
+    # back off while there are no new incidents
+    stats = get_collect_stats(target)
+    if (
+        stats["processed"] >= stats["page_size"]
+        or stats["backlog"] > 0
+        or stats["carried"]
+    ):
+        interval = interval / 2
+    elif stats["processed"] > 0:
+        interval = base_interval
+    else:
+        interval = interval * 2
+
+    interval = min(max(interval, min_interval), max_interval)
+    logging.info(f"Next run in {interval:.0f}s")
+
+    return interval
+
+
+def start_token_refresher(target):
+    # Refresh token in background ahead of its expiration, so runs do not
+    # wait for the token request
+    if target in tokenRefreshers:
+        return
+
+    def refresh():
+        while True:
+            token = mpTokens.get(target)
+            if token is None:
+                time.sleep(10)
+                continue
+
+            delay = (token_refresh_time(token) - datetime.datetime.now()).total_seconds()
+            if delay > 0:
+                time.sleep(min(delay, 60))
+                continue
+
+            try:
+                refresh_token(target, token["access_token"])
+            except Exception as e:
+                logging.error(f"Error on background token refresh: {e}.")
+                time.sleep(30)
+
+    tokenRefreshers.add(target)
+    threading.Thread(target=refresh, name=f"token-{target}", daemon=True).start()
+
+
+def load_state(path):
+    # Savepoint file of previous versions is used until state file is written
+    for state_path in [path, "./savepoint"]:
+        if os.path.exists(state_path):
+            with open(state_path, "r") as file:
+                return file.read()
+
+    return None
+
+
+def save_state(path, savepoint):
+    # Write state to temporary file and atomically replace the state file
+    temp_path = f"{path}.tmp"
+
+    with open(temp_path, "w") as file:
+        file.write(savepoint)
+        file.flush()
+        os.fsync(file.fileno())
+
+    os.replace(temp_path, path)
+
+
+def collect(target, settings, savepoint):
+    # Run is limited by its time budget, schedule interval by default
+    with cycle_budget(get_cycle_budget(settings)):
+        return collect_cycle(target, settings, savepoint)
+
+
+def get_cycle_budget(settings):
+    return (
+        float(settings.get("cycle_budget_seconds", 0))
+        or int(settings.get("schedule", 0)) * 60
+    )
+
+
+def collect_cycle(target, settings, savepoint):
+    logging.info(
+        "Collect run for {} started at {}".format(
+            target, datetime.datetime.now(datetime.timezone.utc)
+        )
+    )
+
+    # Disable warnings
+    requests.packages.urllib3.disable_warnings()
+
+    # Set up incident data cache
+    get_incident_cache(
+        int(settings.get("incident_cache_size", 1000)),
+        int(settings.get("incident_cache_ttl", 600)),
+    )
+
+    # Set up shared HTTP client
+    get_http_client(
+        int(settings.get("http_pool_connections", 10)),
+        max(
+            int(settings.get("http_pool_maxsize", 10)),
+            int(settings.get("enrich_workers", 4)),
+        ),
+    )
+
+    # Set savepoint: watermark of the last processed incident and ids of
+    # already processed incidents in the overlap window
+    state = load_savepoint(savepoint, settings["minutes"])
+    overlap = datetime.timedelta(seconds=int(settings.get("overlap_seconds", 60)))
+    seen_ids_max = int(settings.get("seen_ids_max", 5000))
+
+    try:
+        # Obtain access token
+        with metrics.timer("incsender_stage_duration_seconds", {"stage": "token"}):
+            token = obtain_token(
+                target,
+                settings["first_credential"]["login"],
+                settings["first_credential"]["password"],
+                settings["second_credential"]["password"],
+            )
+        bearerToken = token["access_token"]
+
+        with metrics.timer("incsender_stage_duration_seconds", {"stage": "filter"}):
+            incidents_filter, where = get_incidents_where(bearerToken, target, settings)
+
+        stats = get_collect_stats(target)
+        stats["where"] = where
+
+        # Get incidents page by page and process them in batches of page size
+        page_size = int(settings.get("page_size", 50))
+        incidents_stream = get_incidents_stream(
+            bearerToken, target, settings, state, incidents_filter, where
+        )
+
+        # Incidents are written to the delivery spool and every output
+        # drains it with its own cursor while fetching goes on, if the spool
+        # is enabled. Otherwise every output sends from its own queue
+        spool = get_spool(settings.get("spool_path", ""))
+        sinks = get_run_sinks(bearerToken, target, settings)
+        sink_workers = int(settings.get("sink_workers", 1))
+        stats.update(
+            processed=0, page_size=page_size, backlog=0, carried=False, failed=False
+        )
+
+        if spool is None:
+            dispatcher = SinkDispatcher(
+                sinks, sink_workers, int(settings.get("sink_queue_size", 4))
+            )
+        else:
+            fetched = threading.Event()
+            drains = start_drain(spool, target, sinks, page_size, sink_workers, fetched)
+
+        try:
+            while True:
+                if budget_exhausted():
+                    logging.warning(
+                        "Cycle time budget exhausted, incidents left are carried to the next run"
+                    )
+                    stats["carried"] = True
+                    break
+
+                batch = list(itertools.islice(incidents_stream, page_size))
+                if not batch:
+                    break
+
+                stats["processed"] += len(batch)
+
+                if spool is None:
+                    send_incidents(
+                        bearerToken,
+                        target,
+                        settings,
+                        {"incidents": batch},
+                        dispatcher,
+                        lambda batch=batch: advance_savepoint(
+                            state, batch, overlap, seen_ids_max
+                        ),
+                    )
+                    continue
+
+                spool_incidents(bearerToken, target, settings, spool, batch)
+                advance_savepoint(state, batch, overlap, seen_ids_max)
+
+            if spool is None:
+                dispatcher.complete()
+        finally:
+            if spool is None:
+                dispatcher.cancel()
+            else:
+                fetched.set()
+
+        if spool is not None:
+            stats["backlog"] = drain_backlog(
+                spool, target, sinks, wait_drain(drains), page_size, sink_workers
+            )
+
+        for host, host_stats in get_http_stats().items():
+            logging.info(
+                f"HTTP connections to {host}: opened {host_stats['opened']}, reused {host_stats['reused']}"
+            )
+
+        logging.info(f"Savepoint watermark: {state['watermark']}")
+        set_watermark_lag(target, state)
+
+        return True, dump_savepoint(state)
+
+    except BudgetExhausted as e:
+        logging.warning(f"{e}, incidents left are carried to the next run")
+        get_collect_stats(target)["carried"] = True
+
+        set_watermark_lag(target, state)
+
+        return True, dump_savepoint(state)
+
+    except Exception as e:
+        logging.error("Error while running collect: {}.".format(e))
+        logging.error(traceback.format_exc())
+        get_collect_stats(target)["failed"] = True
+
+        set_watermark_lag(target, state)
+
+        return True, dump_savepoint(state)
+
+
+def get_incidents_where(bearerToken, target, settings):
+    # Get incidents filter from table list
+    incidents_filter = None
+    if (
+        settings["filter_type"].lower() not in ["bl", "wl"]
+        or settings["table_list_name"] == ""
+    ):
+        logging.info(
+            "Skip filtering due to invalid filter type or empty table list name"
+        )
+    else:
+        incidents_filter = get_table_blacklist(
+            bearerToken, target, settings["table_list_name"]
+        )
+
+    # Push incidents filter down into the incidents query
+    where = build_incidents_where(
+        settings["filter_type"].lower(),
+        incidents_filter,
+        int(settings.get("filter_chunk_size", 100)),
+    )
+
+    return incidents_filter, where
+
+
+def get_incidents_stream(bearerToken, target, settings, state, incidents_filter, where):
+    if where is None:
+        logging.info("Whitelist is empty, no incidents to send")
+        return iter([])
+
+    overlap = datetime.timedelta(seconds=int(settings.get("overlap_seconds", 60)))
+
+    return filter_incidents(
+        skip_seen(
+            get_incidents(
+                bearerToken,
+                target,
+                state["watermark"] - overlap,
+                int(settings.get("page_size", 50)),
+                where,
+            ),
+            state["seen"],
+        ),
+        settings["filter_type"].lower(),
+        incidents_filter,
+    )
+
+
+def get_run_sinks(bearerToken, target, settings):
+    # Outputs of the run with their latency trackers and circuit breakers
+    sinks = get_sinks(bearerToken, target, settings)
+    for name in sinks:
+        get_latency_tracker(
+            name,
+            int(settings.get("latency_window", 1000)),
+            float(settings.get("latency_slo_seconds", 0)),
+        )
+        get_circuit_breaker(
+            name,
+            int(settings.get("circuit_failure_threshold", 5)),
+            float(settings.get("circuit_reset_seconds", 60)),
+        )
+
+    return sinks
+
+
+def drain_backlog(spool, target, sinks, failed_sinks, batch_size, workers=1):
+    # Deliver backlog of the core left from previous runs, returns number of
+    # incidents left in spool for working outputs
+    failed_sinks |= drain_spool(
+        spool,
+        target,
+        {name: send for name, send in sinks.items() if name not in failed_sinks},
+        batch_size,
+        workers,
+    )
+    spool.purge(target, list(sinks))
+
+    for name in failed_sinks:
+        logging.error(f"{spool.pending(target, name)} incidents left in spool for {name}")
+
+    return sum(
+        spool.pending(target, name) for name in sinks if name not in failed_sinks
+    )
+
+
+def collect_async(target, settings, savepoint):
+    with cycle_budget(get_cycle_budget(settings)):
+        return asyncio.run(collect_pipeline(target, settings, savepoint))
+
+
+async def collect_pipeline(target, settings, savepoint):
+    # Token, paginated fetch, enrichment and every output run as stages
+    # connected by bounded queues, so a slow output holds back fetching
+    # instead of piling up incidents in memory. Blocking HTTP and syslog
+    # calls run on the loop executor sized for the in-flight limit
+    logging.info(
+        "Async collect run for {} started at {}".format(
+            target, datetime.datetime.now(datetime.timezone.utc)
+        )
+    )
+
+    requests.packages.urllib3.disable_warnings()
+
+    inflight = int(settings.get("async_inflight", 100))
+    queue_size = int(settings.get("async_queue_size", 4))
+
+    get_incident_cache(
+        int(settings.get("incident_cache_size", 1000)),
+        int(settings.get("incident_cache_ttl", 600)),
+    )
+    get_http_client(
+        int(settings.get("http_pool_connections", 10)),
+        max(int(settings.get("http_pool_maxsize", 10)), inflight),
+    )
+    asyncio.get_running_loop().set_default_executor(
+        concurrent.futures.ThreadPoolExecutor(
+            max_workers=inflight, thread_name_prefix="async"
+        )
+    )
+
+    state = load_savepoint(savepoint, settings["minutes"])
+    overlap = datetime.timedelta(seconds=int(settings.get("overlap_seconds", 60)))
+    seen_ids_max = int(settings.get("seen_ids_max", 5000))
+
+    try:
+        with metrics.timer("incsender_stage_duration_seconds", {"stage": "token"}):
+            token = await asyncio.to_thread(
+                obtain_token,
+                target,
+                settings["first_credential"]["login"],
+                settings["first_credential"]["password"],
+                settings["second_credential"]["password"],
+            )
+        bearerToken = token["access_token"]
+
+        with metrics.timer("incsender_stage_duration_seconds", {"stage": "filter"}):
+            incidents_filter, where = await asyncio.to_thread(
+                get_incidents_where, bearerToken, target, settings
+            )
+
+        stats = get_collect_stats(target)
+        stats["where"] = where
+
+        page_size = int(settings.get("page_size", 50))
+        incidents_stream = get_incidents_stream(
+            bearerToken, target, settings, state, incidents_filter, where
+        )
+
+        spool = get_spool(settings.get("spool_path", ""))
+        sinks = get_run_sinks(bearerToken, target, settings)
+        failed_sinks = set()
+        exhausted_sinks = set()
+        stats.update(
+            processed=0, page_size=page_size, backlog=0, carried=False, failed=False
+        )
+
+        fetched_queue = asyncio.Queue(queue_size)
+        enriched_queue = asyncio.Queue(queue_size)
+        sink_queues = {name: asyncio.Queue(queue_size) for name in sinks}
+        semaphore = asyncio.Semaphore(inflight)
+
+        # Batches sent without spool wait here until every output delivered
+        # them, savepoint moves over completed batches only. Once an output
+        # failed, the savepoint cannot move, so no more batches are sent
+        pending = collections.deque()
+
+        def stopped(name):
+            return name in failed_sinks or (spool is None and bool(failed_sinks))
+
+        def complete_batches():
+            while pending and not pending[0]["sinks"]:
+                advance_savepoint(
+                    state, pending.popleft()["incidents"], overlap, seen_ids_max
+                )
+
+        async def fetch():
+            while spool is not None or not failed_sinks:
+                if budget_exhausted():
+                    logging.warning(
+                        "Cycle time budget exhausted, incidents left are carried to the next run"
+                    )
+                    stats["carried"] = True
+                    break
+
+                batch = await asyncio.to_thread(
+                    lambda: list(itertools.islice(incidents_stream, page_size))
+                )
+                if not batch:
+                    break
+
+                stats["processed"] += len(batch)
+                await fetched_queue.put(batch)
+
+            await fetched_queue.put(None)
+
+        async def enrich(incident):
+            async with semaphore:
+                started = time.monotonic()
+                incident_data = await asyncio.to_thread(
+                    get_cached_incident_data, bearerToken, target, incident
+                )
+                metrics.observe(
+                    "incsender_stage_duration_seconds",
+                    {"stage": "enrich"},
+                    time.monotonic() - started,
+                )
+
+            return {
+                **incident,
+                "description": incident_data["description"],
+                "enriched_at": time.time(),
+            }
+
+        async def enrich_batches():
+            # Batches are enriched concurrently and passed on in order
+            while True:
+                batch = await fetched_queue.get()
+                if batch is None:
+                    break
+
+                await enriched_queue.put(
+                    asyncio.ensure_future(
+                        asyncio.gather(*(enrich(incident) for incident in batch))
+                    )
+                )
+
+            await enriched_queue.put(None)
+
+        async def dispatch():
+            while True:
+                enriched = await enriched_queue.get()
+                if enriched is None:
+                    break
+
+                enriched = await enriched
+                if spool is None and failed_sinks:
+                    continue
+
+                incidents = render_incidents(enriched, target, settings["gmt"])
+
+                if spool is not None:
+                    await asyncio.to_thread(
+                        put_to_spool, bearerToken, target, settings, spool, incidents
+                    )
+                    advance_savepoint(state, incidents, overlap, seen_ids_max)
+                    batch = {"incidents": incidents}
+                else:
+                    batch = {"incidents": incidents, "sinks": set(sinks)}
+                    pending.append(batch)
+                    complete_batches()
+
+                for name, queue in sink_queues.items():
+                    if not stopped(name):
+                        await queue.put(batch)
+
+            for queue in sink_queues.values():
+                await queue.put(None)
+
+        async def deliver(name, send, queue):
+            while True:
+                batch = await queue.get()
+                if batch is None:
+                    break
+
+                if stopped(name):
+                    continue
+
+                try:
+                    if spool is not None:
+                        await asyncio.to_thread(
+                            drain_sink, spool, target, name, send, page_size
+                        )
+                    else:
+                        await asyncio.to_thread(
+                            run_sink, name, send, {"incidents": batch["incidents"]}
+                        )
+                except BudgetExhausted:
+                    logging.warning(f"Cycle time budget exhausted, {name} continues next run")
+                    exhausted_sinks.add(name)
+                    failed_sinks.add(name)
+                    continue
+                except Exception as e:
+                    logging.error(f"Error while sending to {name}: {e}.")
+                    failed_sinks.add(name)
+                    continue
+
+                if spool is None:
+                    batch["sinks"].discard(name)
+                    complete_batches()
+
+        tasks = [
+            asyncio.ensure_future(stage)
+            for stage in [
+                fetch(),
+                enrich_batches(),
+                dispatch(),
+                *(deliver(name, send, sink_queues[name]) for name, send in sinks.items()),
+            ]
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        if spool is not None:
+            stats["backlog"] = await asyncio.to_thread(
+                drain_backlog,
+                spool,
+                target,
+                sinks,
+                failed_sinks,
+                page_size,
+                int(settings.get("sink_workers", 1)),
+            )
+        elif failed_sinks - exhausted_sinks:
+            raise Exception(
+                f"Sending to {', '.join(sorted(failed_sinks - exhausted_sinks))} failed"
+            )
+        elif exhausted_sinks:
+            raise BudgetExhausted("Cycle time budget exhausted")
+
+        for host, host_stats in get_http_stats().items():
+            logging.info(
+                f"HTTP connections to {host}: opened {host_stats['opened']}, reused {host_stats['reused']}"
+            )
+
+        logging.info(f"Savepoint watermark: {state['watermark']}")
+        set_watermark_lag(target, state)
+
+        return True, dump_savepoint(state)
+
+    except BudgetExhausted as e:
+        logging.warning(f"{e}, incidents left are carried to the next run")
+        get_collect_stats(target)["carried"] = True
+
+        set_watermark_lag(target, state)
+
+        return True, dump_savepoint(state)
+
+    except Exception as e:
+        logging.error("Error while running collect: {}.".format(e))
+        logging.error(traceback.format_exc())
+        get_collect_stats(target)["failed"] = True
+
+        set_watermark_lag(target, state)
+
+        return True, dump_savepoint(state)
+
+
+class BudgetExhausted(Exception):
+    # Run is out of its time budget, this is not a failure of the endpoint
+    pass
+
+
+@contextlib.contextmanager
+def cycle_budget(seconds, request_cap=None):
+    # Deadline of the current run, HTTP calls of the run get the remaining
+    # time as their timeout, capped so a hanging endpoint times out well
+    # before the run does. Context is copied to worker threads explicitly
+    if request_cap is None and seconds > 0:
+        request_cap = min(REQUEST_TIMEOUT, seconds * REQUEST_BUDGET_SHARE)
+
+    token = cycleDeadline.set(time.monotonic() + seconds if seconds > 0 else None)
+    cap_token = cycleRequestTimeout.set(request_cap)
+    try:
+        yield
+    finally:
+        cycleRequestTimeout.reset(cap_token)
+        cycleDeadline.reset(token)
+
+
+def remaining_budget():
+    deadline = cycleDeadline.get()
+
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def budget_exhausted():
+    remaining = remaining_budget()
+
+    return remaining is not None and remaining <= 0
+
+
+def request_timeout():
+    # Only a request refused here is not counted as a failure of the
+    # endpoint, a timeout of a started request is
+    remaining = remaining_budget()
+    if remaining is None:
+        return REQUEST_TIMEOUT
+    if remaining <= 0:
+        raise BudgetExhausted("Cycle time budget exhausted")
+
+    return min(remaining, cycleRequestTimeout.get() or REQUEST_TIMEOUT)
+
+
+def set_watermark_lag(target, state):
+    metrics.set(
+        "incsender_watermark_lag_seconds",
+        {"target": target},
+        (datetime.datetime.now(datetime.timezone.utc) - state["watermark"]).total_seconds(),
+    )
+
+
+def parse_created(created):
+    # MP10 returns time in GMT+0 with 7 digits of fractional seconds
+    return datetime.datetime.strptime(created[:26], "%Y-%m-%dT%H:%M:%S.%f").replace(
+        tzinfo=datetime.timezone.utc
+    )
+
+
+def load_savepoint(savepoint, minutes):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    state = {"watermark": now - datetime.timedelta(minutes=minutes), "seen": {}}
+
+    if savepoint is None or not isinstance(savepoint, str):
+        return state
+
+    try:
+        if savepoint.startswith("{"):
+            saved = json.loads(savepoint)
+            state["watermark"] = datetime.datetime.strptime(
+                saved["watermark"], "%Y-%m-%dT%H:%M:%S.%f%z"
+            )
+            state["seen"] = saved.get("seen", {})
+        else:
+            # Savepoint of previous versions is a plain time
+            state["watermark"] = datetime.datetime.strptime(
+                savepoint, "%Y-%m-%dT%H:%M:%S.%f%z"
+            )
+    except Exception as e:
+        logging.error("Error on savepoint processing: {}.".format(e))
+        state["watermark"] = now
+
+    if (now - state["watermark"]).days > 1:
+        state["watermark"] = now - datetime.timedelta(minutes=minutes)
+
+    return state
+
+
+def dump_savepoint(state):
+    return json.dumps(
+        {
+            "watermark": state["watermark"].strftime("%Y-%m-%dT%H:%M:%S.%f%z"),
+            "seen": state["seen"],
+        }
+    )
+
+
+def advance_savepoint(state, incidents, overlap, seen_ids_max):
+    # Move watermark to the last processed incident and keep ids of
+    # incidents which can be returned again in the overlap window
+    for incident in incidents:
+        state["seen"][incident["id"]] = incident["created"]
+        state["watermark"] = max(state["watermark"], parse_created(incident["created"]))
+
+    window_start = state["watermark"] - overlap
+    seen = sorted(
+        (
+            (created, id)
+            for id, created in state["seen"].items()
+            if parse_created(created) >= window_start
+        ),
+        reverse=True,
+    )[:seen_ids_max]
+    state["seen"] = {id: created for created, id in seen}
+
+
+def skip_seen(incidents, seen):
+    for incident in incidents:
+        if incident["id"] not in seen:
+            yield incident
+
+
+def build_incidents_where(filter_type, incidents_filter, chunk_size=100):
+    # Build PDQL where clause for incidents query, long names lists are
+    # split into several in/not in conditions of chunk_size names each
+    where = '(status != "Closed")'
+
+    if incidents_filter is None:
+        return where
+
+    names = sorted(incidents_filter)
+    if not names:
+        return None if filter_type == "wl" else where
+
+    conditions = []
+    for index in range(0, len(names), chunk_size):
+        quoted = ", ".join(
+            '"{}"'.format(name.replace("\\", "\\\\").replace('"', '\\"'))
+            for name in names[index : index + chunk_size]
+        )
+        if filter_type == "wl":
+            conditions.append(f"name in ({quoted})")
+        else:
+            conditions.append(f"name not in ({quoted})")
+
+    if filter_type == "wl":
+        return f"{where} and ({' or '.join(conditions)})"
+    else:
+        return f"{where} and {' and '.join(conditions)}"
+
+
+def filter_incidents(incidents, filter_type, incidents_filter):
+    # Apply bl/wl table list filter to incidents stream
+    if incidents_filter is None:
+        yield from incidents
+        return
+
+    for incident in incidents:
+        listed = incident["name"] in incidents_filter
+        if (filter_type == "bl" and not listed) or (filter_type == "wl" and listed):
+            yield incident
+        else:
+            metrics.inc("incsender_incidents_filtered_total")
+
+
+def enrich_incidents(bearerToken, target, incidents, workers):
+    # Fetch incident data concurrently, keeping incidents order
+    def enrich(incident):
+        started = time.monotonic()
+        incident_data = get_cached_incident_data(bearerToken, target, incident)
+        latency = time.monotonic() - started
+
+        metrics.observe("incsender_stage_duration_seconds", {"stage": "enrich"}, latency)
+        logging.info(f"{incident['key']} enriched in {latency:.3f}s")
+
+        return {
+            **incident,
+            "description": incident_data["description"],
+            "enriched_at": time.time(),
+        }, latency
+
+    if not incidents:
+        return []
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(contextvars.copy_context().run, enrich, incident)
+            for incident in incidents
+        ]
+        results = [future.result() for future in futures]
+
+    latencies = [latency for _, latency in results]
+    logging.info(
+        f"Enriched {len(results)} incidents with {workers} workers: "
+        f"avg {sum(latencies) / len(latencies):.3f}s, max {max(latencies):.3f}s"
+    )
 
-        has_more, savepoint = collect(target, settings, savepoint)
+    return [incident for incident, _ in results]
 
-        with open("savepoint", "w") as file:
-            file.write(str(savepoint))
 
-        time.sleep(int(settings["schedule"])*60)
+def render_incident(incident, core_address, gmt):
+    # Canonical view of incident shared by all outputs: local creation time
+    # and links are built once per incident
+    created = parse_created(incident["created"])
 
+    return {
+        **incident,
+        "core_address": core_address,
+        "created_local": (created + datetime.timedelta(hours=gmt)).strftime(
+            "%H:%M:%S %d.%m.%Y"
+        ),
+        "incident_link": f"https://{core_address}/#/incident/incidents/view/{incident['id']}",
+        "events_link": f"https://{core_address}/#/events/view?groupId=-1&incKey={incident['key']}&incidentId={incident['id']}&incidentName={incident['name']}",
+    }
 
-def collect(target, settings, savepoint):
-    logging.info(
-        "Collect run started at {}".format(datetime.datetime.now(datetime.timezone.utc))
+
+def render_incidents(incidents, core_address, gmt):
+    with metrics.timer("incsender_stage_duration_seconds", {"stage": "render"}):
+        return [render_incident(incident, core_address, gmt) for incident in incidents]
+
+
+def send_incidents(bearerToken, target, settings, incidents, dispatcher, done):
+    # Enrich incidents with description and render them for outputs
+    incidents["incidents"] = render_incidents(
+        enrich_incidents(
+            bearerToken,
+            target,
+            incidents["incidents"],
+            int(settings.get("enrich_workers", 4)),
+        ),
+        target,
+        settings["gmt"],
     )
 
-    # Disable warnings
-    requests.packages.urllib3.disable_warnings()
+    # Queue incidents to outputs, done is called once all of them delivered
+    dispatcher.submit(incidents, done)
 
-    # Set savepoint.
-    # TODO: More flexible savepoint processing
-    if savepoint is None or not isinstance(savepoint, str):
-        savepoint = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
-            minutes=settings["minutes"]
+
+def get_sinks(bearerToken, target, settings):
+    # Map of enabled outputs to functions sending a batch of incidents
+    sinks = {}
+
+    if settings["tg_enabled"] and settings["tg_token"] and settings["chat_id"]:
+        sinks["telegram"] = lambda incidents: send_to_telegram(
+            incidents,
+            settings["tg_token"],
+            settings["chat_id"],
+            int(settings.get("tg_merge_threshold", 20)),
+            int(settings.get("tg_chat_rate", 20)),
+        )
+
+    if settings["mm_enabled"] and settings["mm_webhook_url"]:
+        sinks["mattermost"] = lambda incidents: send_to_mattermost(
+            incidents,
+            settings["mm_webhook_url"],
+            settings["mm_username"],
+            int(settings.get("mm_digest_threshold", 0)),
+        )
+
+    if settings["syslog_enabled"] and settings["syslog_server"]:
+        def syslog_sink(incidents):
+            if settings["syslog_full_body"]:
+                incidents = [
+                    get_cached_incident_data(
+                        bearerToken, incident.get("core_address", target), incident
+                    )
+                    for incident in incidents["incidents"]
+                ]
+
+            send_to_syslog(
+                incidents,
+                settings["syslog_server"],
+                settings["syslog_proto"],
+                settings["syslog_port"],
+                settings["syslog_full_body"],
+                settings.get("syslog_framing", "lf"),
+                settings.get("syslog_tls", False),
+                settings.get("syslog_tls_verify", True),
+                parse_fields(settings.get("syslog_fields_include", "")),
+                parse_fields(settings.get("syslog_fields_exclude", "")),
+            )
+
+        sinks["syslog"] = syslog_sink
+
+    if settings["teams_enabled"] and settings["teams_webhook_url"]:
+        sinks["teams"] = lambda incidents: send_to_teams(
+            incidents,
+            settings["teams_webhook_url"],
+            int(settings.get("teams_digest_threshold", 0)),
         )
-    else:
-        try:
-            savepoint = datetime.datetime.strptime(savepoint, "%Y-%m-%dT%H:%M:%S.%f%z")
-        except Exception as e:
-            logging.info("Error on savepoint processing: {}.".format(e))
-            savepoint = datetime.datetime.now(datetime.timezone.utc)
 
-    if (datetime.datetime.now(datetime.timezone.utc) - savepoint).days > 1:
-        savepoint = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
-            minutes=settings["minutes"]
+    # Formatting-heavy outputs are delivered by the pool of worker processes
+    processes = int(settings.get("delivery_processes", 0))
+    if processes > 0:
+        pool = get_delivery_pool(
+            processes, int(settings.get("delivery_queue_size", 0)) or processes * 2
         )
+        for name in parse_fields(settings.get("delivery_process_sinks", "syslog,teams")) or []:
+            if name in sinks:
+                sinks[name] = pool_sink(pool, name, bearerToken, target, settings)
+
+    return sinks
+
+
+def get_sink_executor(name, workers=1):
+    # Every output has its own worker pool, so a hanging output does not
+    # delay the others
+    if name not in sinkExecutors:
+        sinkExecutors[name] = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix=f"sink-{name}"
+        )
+
+    return sinkExecutors[name]
+
+
+def run_sink(name, send, incidents):
+    started = time.monotonic()
+    count = len(incidents["incidents"])
+
+    # Running out of time budget is not counted as a failure of the output
+    if budget_exhausted():
+        raise BudgetExhausted(f"Cycle time budget exhausted before sending to {name}")
+
+    breaker = get_circuit_breaker(name)
+    if not breaker.allow():
+        metrics.inc("incsender_incidents_failed_total", {"sink": name}, count)
+        raise Exception(f"Circuit breaker for {name} is {breaker.state}")
 
     try:
-        # Obtain access token
-        token = obtain_token(
-            target,
-            settings["first_credential"]["login"],
-            settings["first_credential"]["password"],
-            settings["second_credential"]["password"],
+        send(incidents)
+    except BudgetExhausted:
+        breaker.release()
+        raise
+    except Exception:
+        breaker.failure()
+        metrics.inc("incsender_incidents_failed_total", {"sink": name}, count)
+        raise
+
+    breaker.success()
+
+    elapsed = time.monotonic() - started
+    metrics.observe(
+        "incsender_stage_duration_seconds", {"stage": "send", "sink": name}, elapsed
+    )
+    metrics.inc("incsender_incidents_delivered_total", {"sink": name}, count)
+    track_latency(name, incidents["incidents"])
+    logging.info(
+        f"Sent {count} incidents to {name} in {elapsed:.3f}s "
+        f"({count / elapsed if elapsed else 0:.1f} incidents/s)"
+    )
+
+
+class CircuitBreaker:
+    # Output is closed after consecutive failures: calls fail fast while
+    # open, after reset timeout one probe call is let through (half-open)
+    def __init__(self, name, threshold=5, reset_timeout=60):
+        self.lock = threading.Lock()
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0
+        self.probing = False
+
+    def allow(self):
+        with self.lock:
+            if self.state == "open":
+                if time.time() - self.opened_at < self.reset_timeout:
+                    return False
+                self.transition("half-open")
+
+            if self.state == "half-open":
+                if self.probing:
+                    return False
+                self.probing = True
+
+            return True
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.probing = False
+            if self.state != "closed":
+                self.transition("closed")
+
+    def release(self):
+        # Call was not made to the end, let another probe through
+        with self.lock:
+            self.probing = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.state == "half-open" or (
+                self.state == "closed" and self.failures >= self.threshold
+            ):
+                self.opened_at = time.time()
+                self.transition("open")
+
+    def transition(self, state):
+        reason = f" after {self.failures} consecutive failures" if state == "open" else ""
+        logging.warning(f"Circuit breaker for {self.name}: {self.state} -> {state}{reason}")
+        self.state = state
+        metrics.set(
+            "incsender_circuit_state",
+            {"sink": self.name},
+            {"closed": 0, "half-open": 1, "open": 2}[state],
         )
-        bearerToken = token["access_token"]
+        metrics.inc("incsender_circuit_transitions_total", {"sink": self.name, "state": state})
 
-        # Get incidents
-        incidents = get_incidents(bearerToken, target, savepoint)
 
-        # Get incidents filter from table list and filter incidents
-        if (
-            settings["filter_type"].lower() not in ["bl", "wl"]
-            or settings["table_list_name"] == ""
-        ):
-            logging.info(
-                "Skip filtering due to invalid filter type or empty table list name"
+def get_circuit_breaker(name, threshold=None, reset_timeout=None):
+    breaker = circuitBreakers.get(name)
+
+    if breaker is None:
+        breaker = circuitBreakers[name] = CircuitBreaker(
+            name, threshold or 5, reset_timeout or 60
+        )
+    if threshold:
+        breaker.threshold = threshold
+    if reset_timeout:
+        breaker.reset_timeout = reset_timeout
+
+    return breaker
+
+
+class LatencyTracker:
+    # Rolling window of end-to-end latencies of incidents delivered to one
+    # output, from creation in MP10 to delivery
+    def __init__(self, window=1000, slo=0):
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=window)
+        self.slo = slo
+
+    def add(self, latencies):
+        with self.lock:
+            self.latencies.extend(latencies)
+
+    def percentiles(self, quantiles=(0.5, 0.95, 0.99)):
+        with self.lock:
+            latencies = sorted(self.latencies)
+
+        if not latencies:
+            return {quantile: 0 for quantile in quantiles}
+
+        return {
+            quantile: latencies[min(len(latencies) - 1, int(quantile * len(latencies)))]
+            for quantile in quantiles
+        }
+
+
+def get_latency_tracker(name, window=None, slo=None):
+    tracker = latencyTrackers.get(name)
+
+    if tracker is None or (window and tracker.latencies.maxlen != window):
+        tracker = latencyTrackers[name] = LatencyTracker(window or 1000, slo or 0)
+    elif slo is not None:
+        tracker.slo = slo
+
+    return tracker
+
+
+def track_latency(name, incidents):
+    # Incidents carry times of fetching and enrichment, delivery time is now
+    if not incidents:
+        return
+
+    delivered = time.time()
+    tracker = get_latency_tracker(name)
+
+    stages = {"fetch": [], "enrich": [], "deliver": [], "total": []}
+    for incident in incidents:
+        created = parse_created(incident["created"]).timestamp()
+        fetched = incident.get("fetched_at", delivered)
+        enriched = incident.get("enriched_at", fetched)
+
+        stages["fetch"].append(fetched - created)
+        stages["enrich"].append(enriched - fetched)
+        stages["deliver"].append(delivered - enriched)
+        stages["total"].append(delivered - created)
+
+    for stage, latencies in stages.items():
+        for latency in latencies:
+            metrics.observe(
+                "incsender_delivery_latency_seconds",
+                {"sink": name, "stage": stage},
+                latency,
             )
-        else:
-            filter = get_table_blacklist(
-                bearerToken, target, settings["table_list_name"]
+
+    tracker.add(stages["total"])
+    percentiles = tracker.percentiles()
+
+    for quantile, latency in percentiles.items():
+        metrics.set(
+            "incsender_delivery_latency_quantile_seconds",
+            {"sink": name, "quantile": quantile},
+            latency,
+        )
+
+    logging.info(
+        f"Latency to {name}: fetch avg {sum(stages['fetch']) / len(incidents):.3f}s, "
+        f"enrich avg {sum(stages['enrich']) / len(incidents):.3f}s, "
+        f"deliver avg {sum(stages['deliver']) / len(incidents):.3f}s; end-to-end "
+        f"p50 {percentiles[0.5]:.3f}s, p95 {percentiles[0.95]:.3f}s, p99 {percentiles[0.99]:.3f}s "
+        f"over last {len(tracker.latencies)} incidents"
+    )
+
+    if tracker.slo:
+        late = [latency for latency in stages["total"] if latency > tracker.slo]
+        if late:
+            metrics.inc("incsender_latency_slo_breaches_total", {"sink": name}, len(late))
+            logging.warning(
+                f"Latency SLO breach: {len(late)} of {len(incidents)} incidents delivered "
+                f"to {name} later than {tracker.slo}s after creation, max {max(late):.3f}s"
             )
-            if settings["filter_type"].lower() == "bl":
-                incidents["incidents"] = [
-                    incident
-                    for incident in incidents["incidents"]
-                    if not any(
-                        incident["name"] == item["name"]
-                        for item in filter.get("items", [])
-                    )
-                ]
-            elif settings["filter_type"].lower() == "wl":
-                incidents["incidents"] = [
-                    incident
-                    for incident in incidents["incidents"]
-                    if any(
-                        incident["name"] == item["name"]
-                        for item in filter.get("items", [])
-                    )
-                ]
 
-        # Enrich incidents with description
-        incidents["incidents"] = [
-            {
-                **incident,
-                "description": get_incident_data(bearerToken, target, incident["id"])[
-                    "description"
-                ],
-            }
-            for incident in incidents["incidents"]
-        ]
 
-        # Send incidents to outputs
-        if settings["tg_enabled"] and settings["tg_token"] and settings["chat_id"]:
-            send_to_telegram(
-                incidents,
-                settings["tg_token"],
-                settings["chat_id"],
-                target,
-                settings["gmt"],
+class SinkDispatcher:
+    # Every output sends batches from its own worker pool without waiting
+    # for the other outputs. Batches are completed in fetch order once all
+    # outputs delivered them, fetching waits only for an output that is
+    # queue_size batches behind
+    def __init__(self, sinks, workers=1, queue_size=4):
+        self.sinks = sinks
+        self.workers = workers
+        self.queue_size = max(queue_size, 1)
+        self.pending = collections.deque()
+
+    def submit(self, incidents, done):
+        futures = {
+            name: get_sink_executor(name, self.workers).submit(
+                contextvars.copy_context().run, run_sink, name, send, incidents
             )
+            for name, send in self.sinks.items()
+        }
+        self.pending.append((futures, done))
+
+        self.complete(self.queue_size)
+
+    def complete(self, queue_size=0):
+        # Complete delivered batches, the oldest batch is waited for while
+        # more than queue_size batches are pending
+        while self.pending:
+            futures, done = self.pending[0]
+            if len(self.pending) <= queue_size and not all(
+                future.done() for future in futures.values()
+            ):
+                return
+
+            failed = []
+            exhausted = []
+            for name, future in futures.items():
+                try:
+                    future.result()
+                except BudgetExhausted:
+                    exhausted.append(name)
+                except Exception as e:
+                    logging.error(f"Error while sending to {name}: {e}.")
+                    failed.append(name)
+
+            # Savepoint stays before the failed batch, so batches queued
+            # after it are not sent in this run
+            if failed or exhausted:
+                self.cancel()
+            if failed:
+                raise Exception(f"Sending to {', '.join(failed)} failed")
+            if exhausted:
+                raise BudgetExhausted(
+                    f"Cycle time budget exhausted before sending to {', '.join(exhausted)}"
+                )
 
-        if settings["mm_enabled"] and settings["mm_webhook_url"]:
-            send_to_mattermost(
-                incidents,
-                settings["mm_webhook_url"],
+            self.pending.popleft()
+            done()
+
+    def cancel(self):
+        for futures, _ in self.pending:
+            for future in futures.values():
+                future.cancel()
+
+        self.pending.clear()
+
+
+class DeliverySpool:
+    # Persistent SQLite (WAL) spool between collection and outputs, every
+    # output of a core reads rows of the core with its own cursor and
+    # acknowledges delivered rows
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS incidents ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "target TEXT NOT NULL, "
+            "incident_id TEXT NOT NULL, "
+            "incident TEXT NOT NULL, "
+            "data TEXT, "
+            "UNIQUE (target, incident_id))"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS sink_cursors ("
+            "target TEXT NOT NULL, sink TEXT NOT NULL, seq INTEGER NOT NULL, "
+            "PRIMARY KEY (target, sink))"
+        )
+
+        # Cursors of previous versions are shared by all cores, they are
+        # copied to every core having rows in the spool
+        legacy = self.connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'cursors'"
+        ).fetchone()
+        if legacy:
+            with self.connection:
+                self.connection.execute("BEGIN")
+                self.connection.execute(
+                    "INSERT OR IGNORE INTO sink_cursors (target, sink, seq) "
+                    "SELECT targets.target, cursors.sink, cursors.seq FROM cursors, "
+                    "(SELECT DISTINCT target FROM incidents) AS targets"
+                )
+                self.connection.execute("DROP TABLE cursors")
+
+        self.sink_locks = collections.defaultdict(threading.Lock)
+        self.added = threading.Condition()
+
+    def put(self, target, incidents, incidents_data):
+        rows = [
+            (
                 target,
-                settings["gmt"],
-                settings["mm_username"],
+                incident["id"],
+                json.dumps(incident, ensure_ascii=False),
+                None if data is None else json.dumps(data, ensure_ascii=False),
             )
+            for incident, data in zip(incidents, incidents_data)
+        ]
 
-        if settings["syslog_enabled"] and settings["syslog_server"]:
-            if settings["syslog_full_body"]:
-                full_incidents = [
-                    json.dumps(
-                        get_incident_data(bearerToken, target, incident["id"]),
-                        ensure_ascii=False,
-                    )
-                    for incident in incidents["incidents"]
-                ]
-                send_to_syslog(
-                    full_incidents,
-                    settings["gmt"],
-                    settings["syslog_server"],
-                    target,
-                    settings["syslog_proto"],
-                    settings["syslog_port"],
-                    settings["syslog_full_body"],
+        with self.lock:
+            with self.connection:
+                self.connection.execute("BEGIN")
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO incidents (target, incident_id, incident, data) "
+                    "VALUES (?, ?, ?, ?)",
+                    rows,
                 )
+
+        with self.added:
+            self.added.notify_all()
+
+    def wait(self, timeout):
+        # Wait for new rows put by collection
+        with self.added:
+            self.added.wait(timeout)
+
+    def cursor(self, target, sink):
+        row = self.connection.execute(
+            "SELECT seq FROM sink_cursors WHERE target = ? AND sink = ?", (target, sink)
+        ).fetchone()
+
+        return 0 if row is None else row[0]
+
+    def read(self, target, sink, limit):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT seq, target, incident, data FROM incidents "
+                "WHERE target = ? AND seq > ? ORDER BY seq LIMIT ?",
+                (target, self.cursor(target, sink), limit),
+            ).fetchall()
+
+        return [
+            (seq, target, json.loads(incident), None if data is None else json.loads(data))
+            for seq, target, incident, data in rows
+        ]
+
+    def ack(self, target, sink, seq):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO sink_cursors (target, sink, seq) VALUES (?, ?, ?)",
+                (target, sink, seq),
+            )
+
+    def pending(self, target, sink):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM incidents WHERE target = ? AND seq > ?",
+                (target, self.cursor(target, sink)),
+            ).fetchone()[0]
+
+    def purge(self, target, sinks):
+        # Remove rows of the core acknowledged by all its enabled outputs and
+        # by every output that ever read the core, also the disabled ones
+        with self.lock:
+            cursors = dict(
+                self.connection.execute(
+                    "SELECT sink, seq FROM sink_cursors WHERE target = ?", (target,)
+                ).fetchall()
+            )
+            if not sinks and not cursors:
+                acked = self.connection.execute(
+                    "SELECT MAX(seq) FROM incidents WHERE target = ?", (target,)
+                ).fetchone()[0]
             else:
-                send_to_syslog(
-                    incidents,
-                    settings["gmt"],
-                    settings["syslog_server"],
-                    target,
-                    settings["syslog_proto"],
-                    settings["syslog_port"],
-                    settings["syslog_full_body"],
+                acked = min(cursors.get(sink, 0) for sink in {*sinks, *cursors})
+
+            if acked:
+                self.connection.execute(
+                    "DELETE FROM incidents WHERE target = ? AND seq <= ?", (target, acked)
                 )
 
-        if settings["teams_enabled"] and settings["teams_webhook_url"]:
-            send_to_teams(
-                incidents, settings["teams_webhook_url"], target, settings["gmt"]
-            )
 
-        # Process savepoint
-        savepoint = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f%z")
+def get_spool(path):
+    global deliverySpool
 
-        return True, savepoint
+    if not path:
+        return None
 
-    except Exception as e:
-        logging.error("Error while running collect: {}.".format(e))
-        logging.error(traceback.format_exc())
+    if deliverySpool is None:
+        deliverySpool = DeliverySpool(path)
 
-        return True, savepoint
+    return deliverySpool
 
 
-# Perform HTTP request
-def make_request(method, url, headers=None, data=None):
-    with requests.Session() as session:
-        retries = Retry(
-            total=5, backoff_factor=1, status_forcelist=[502, 503, 504, 401]
+def spool_incidents(bearerToken, target, settings, spool, incidents):
+    put_to_spool(
+        bearerToken,
+        target,
+        settings,
+        spool,
+        render_incidents(
+            enrich_incidents(
+                bearerToken, target, incidents, int(settings.get("enrich_workers", 4))
+            ),
+            target,
+            settings["gmt"],
+        ),
+    )
+
+
+def put_to_spool(bearerToken, target, settings, spool, incidents):
+    # Full incident data is spooled too, so syslog does not need the core
+    # to be reachable when it drains the spool
+    if settings["syslog_enabled"] and settings["syslog_full_body"]:
+        incidents_data = [
+            get_cached_incident_data(bearerToken, target, incident)
+            for incident in incidents
+        ]
+    else:
+        incidents_data = [None] * len(incidents)
+
+    spool.put(target, incidents, incidents_data)
+
+
+def drain_sink(spool, target, name, send, batch_size, workers=1, fetched=None):
+    # Output drains the spool until it is empty, and until fetching of the
+    # run is over if fetched event is given
+    while True:
+        # Rows left in spool are delivered by the next run
+        if budget_exhausted():
+            logging.warning(f"Cycle time budget exhausted, {name} continues next run")
+            break
+
+        over = fetched is None or fetched.is_set()
+
+        # Only one drain of an output of the core at a time
+        with spool.sink_locks[(target, name)]:
+            delivered = drain_sink_rows(spool, target, name, send, batch_size, workers)
+
+        if not delivered:
+            if over:
+                break
+            spool.wait(1)
+
+
+def drain_sink_rows(spool, target, name, send, batch_size, workers=1):
+    # Up to workers batches are sent at once on the output's worker pool,
+    # the cursor moves over batches delivered in order
+    rows = spool.read(target, name, batch_size * workers)
+    if not rows:
+        return 0
+
+    # Put spooled incident data back to cache for the full body syslog
+    for _, _, incident, data in rows:
+        if data is not None:
+            get_incident_cache().put(incident_cache_key(target, incident), data)
+
+    batches = [rows[start:start + batch_size] for start in range(0, len(rows), batch_size)]
+    futures = [
+        get_sink_executor(name, workers).submit(
+            contextvars.copy_context().run,
+            run_sink,
+            name,
+            send,
+            {"incidents": [incident for _, _, incident, _ in batch]},
+        )
+        for batch in batches
+    ]
+
+    try:
+        for batch, future in zip(batches, futures):
+            future.result()
+            spool.ack(target, name, batch[-1][0])
+    finally:
+        for future in futures:
+            future.cancel()
+
+    return len(rows)
+
+
+def start_drain(spool, target, sinks, batch_size, workers=1, fetched=None):
+    # Every output drains rows of the core in its own thread, independent
+    # of the other outputs
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(len(sinks), 1), thread_name_prefix="drain"
+    )
+    futures = {
+        name: executor.submit(
+            contextvars.copy_context().run,
+            drain_sink,
+            spool,
+            target,
+            name,
+            send,
+            batch_size,
+            workers,
+            fetched,
+        )
+        for name, send in sinks.items()
+    }
+    executor.shutdown(wait=False)
+
+    return futures
+
+
+def wait_drain(futures):
+    # Wait for drains of outputs, returns names of outputs failed to deliver
+    failed = set()
+    for name, future in futures.items():
+        try:
+            future.result()
+        except BudgetExhausted:
+            logging.warning(f"Cycle time budget exhausted, {name} continues next run")
+        except Exception as e:
+            logging.error(f"Error while sending to {name}: {e}.")
+            failed.add(name)
+
+    return failed
+
+
+def drain_spool(spool, target, sinks, batch_size, workers=1):
+    return wait_drain(start_drain(spool, target, sinks, batch_size, workers))
+
+
+class DeliveryPool:
+    # Worker processes formatting and sending incidents to outputs, tasks are
+    # passed through a bounded queue and results are matched by task id
+    def __init__(self, processes, queue_size):
+        context = multiprocessing.get_context("spawn")
+        self.context = context
+        self.tasks = context.Queue(queue_size)
+        self.results = context.Queue()
+        self.lock = threading.Lock()
+        self.futures = {}
+        self.ids = itertools.count()
+        self.processes = [self.start_process() for _ in range(processes)]
+
+        threading.Thread(
+            target=self.collect_results, name="delivery-results", daemon=True
+        ).start()
+
+    def start_process(self):
+        process = self.context.Process(
+            target=delivery_worker, args=(self.tasks, self.results), daemon=True
         )
-        session.mount("https://", HTTPAdapter(max_retries=retries))
-        response = session.request(
-            method, url, headers=headers, data=data, verify=False, timeout=360
+        process.start()
+
+        return process
+
+    def submit(self, *task):
+        future = concurrent.futures.Future()
+        task_id = next(self.ids)
+
+        with self.lock:
+            self.futures[task_id] = future
+
+        # Blocks while the queue is full, so collection waits for delivery
+        self.tasks.put((task_id, task))
+
+        return future
+
+    def collect_results(self):
+        while True:
+            try:
+                task_id, error, exhausted = self.results.get(timeout=5)
+            except Exception:
+                self.check_processes()
+                continue
+
+            with self.lock:
+                future = self.futures.pop(task_id, None)
+
+            if future is None:
+                continue
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(
+                    BudgetExhausted(error) if exhausted else Exception(error)
+                )
+
+    def check_processes(self):
+        # Tasks of a died process are lost, fail all pending ones and start
+        # a new process instead
+        died = [process for process in self.processes if not process.is_alive()]
+        if not died:
+            return
+
+        logging.error(f"{len(died)} delivery processes exited, restarting")
+
+        with self.lock:
+            futures, self.futures = self.futures, {}
+
+        for future in futures.values():
+            future.set_exception(Exception("Delivery process exited"))
+
+        self.processes = [
+            process if process.is_alive() else self.start_process()
+            for process in self.processes
+        ]
+
+
+def get_delivery_pool(processes, queue_size):
+    global deliveryPool
+
+    if deliveryPool is None:
+        deliveryPool = DeliveryPool(processes, queue_size)
+        logging.info(f"Started {processes} delivery processes")
+
+    return deliveryPool
+
+
+CHAT_SINKS = ("telegram", "mattermost", "teams")
+
+
+def pool_sink(pool, name, bearerToken, target, settings):
+    # Batch is split between worker processes, full incident data for the
+    # syslog is taken from the cache of this process
+    settings = {**settings, "delivery_processes": 0}
+
+    def send(incidents):
+        incidents = incidents["incidents"]
+        if not incidents:
+            return
+
+        if name == "syslog" and settings["syslog_full_body"]:
+            incidents_data = [
+                get_cached_incident_data(
+                    bearerToken, incident.get("core_address", target), incident
+                )
+                for incident in incidents
+            ]
+        else:
+            incidents_data = [None] * len(incidents)
+
+        # Chat outputs get the whole batch so the digest threshold sees it
+        if name in CHAT_SINKS:
+            size = len(incidents)
+        else:
+            size = -(-len(incidents) // len(pool.processes))
+        futures = [
+            pool.submit(
+                remaining_budget(),
+                cycleRequestTimeout.get(),
+                name,
+                bearerToken,
+                target,
+                settings,
+                incidents[start:start + size],
+                incidents_data[start:start + size],
+            )
+            for start in range(0, len(incidents), size)
+        ]
+
+        for future in futures:
+            future.result()
+
+    return send
+
+
+def delivery_worker(tasks, results):
+    while True:
+        task_id, task = tasks.get()
+        (
+            budget,
+            request_cap,
+            name,
+            bearerToken,
+            target,
+            settings,
+            incidents,
+            incidents_data,
+        ) = task
+
+        try:
+            for incident, data in zip(incidents, incidents_data):
+                if data is not None:
+                    get_incident_cache().put(
+                        incident_cache_key(incident.get("core_address", target), incident),
+                        data,
+                    )
+
+            with cycle_budget(budget or 0, request_cap):
+                get_sinks(bearerToken, target, settings)[name]({"incidents": incidents})
+            results.put((task_id, None, False))
+        except Exception as e:
+            logging.error(f"Error while sending to {name} in delivery process: {e}.")
+            results.put((task_id, str(e), isinstance(e, BudgetExhausted)))
+
+
+# Get process-wide HTTP client with per-host keep-alive pools
+def get_http_client(pool_connections=10, pool_maxsize=10):
+    global httpClient
+
+    if httpClient is None:
+        # Retries are made by send_request within the cycle time budget
+        adapter = HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            max_retries=0,
         )
 
-    if response.ok or (method == "POST" and response.status_code == 400):
+        httpClient = requests.Session()
+        httpClient.mount("https://", adapter)
+        httpClient.mount("http://", adapter)
+
+    return httpClient
+
+
+# Count connections opened vs reused by HTTP client pools
+def get_http_stats():
+    stats = {}
+
+    if httpClient is None:
+        return stats
+
+    for adapter in set(httpClient.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            host_stats = stats.setdefault(pool.host, {"opened": 0, "reused": 0})
+            host_stats["opened"] += pool.num_connections
+            host_stats["reused"] += max(pool.num_requests - pool.num_connections, 0)
+
+    return stats
+
+
+def send_request(method, url, headers=None, data=None):
+    # Retry failed connections and 502/503/504 of idempotent requests with
+    # jittered exponential backoff, while the cycle time budget allows
+    attempt = 0
+
+    while True:
+        response = None
+        try:
+            response = get_http_client().request(
+                method,
+                url,
+                headers=headers,
+                data=data,
+                verify=False,
+                timeout=request_timeout(),
+            )
+            if method not in IDEMPOTENT_METHODS or response.status_code not in RETRY_STATUSES:
+                return response
+            error = f"status {response.status_code}"
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if isinstance(e, requests.ReadTimeout) and method not in IDEMPOTENT_METHODS:
+                raise
+            error = e
+
+        attempt += 1
+        delay = random.uniform(0, RETRY_BACKOFF * 2 ** attempt)
+        remaining = remaining_budget()
+        if attempt > RETRY_TOTAL or (remaining is not None and remaining <= delay):
+            if response is not None:
+                return response
+            raise error
+
+        metrics.inc("incsender_http_retries_total", {"host": urllib.parse.urlsplit(url).hostname})
+        logging.warning(f"Retrying {method} {url} in {delay:.1f}s after {error}")
+        time.sleep(delay)
+
+
+# Perform HTTP request
+def make_request(method, url, headers=None, data=None, accept_status=()):
+    core_address = urllib.parse.urlsplit(url).netloc
+    authorization = (headers or {}).get("Authorization", "")
+    managed = authorization.startswith("Bearer ") and core_address in tokenCredentials
+
+    # Use the current token of the core, it could be refreshed while the
+    # request was prepared
+    if managed and core_address in mpTokens:
+        headers = {
+            **headers,
+            "Authorization": "Bearer " + mpTokens[core_address]["access_token"],
+        }
+
+    response = send_request(method, url, headers=headers, data=data)
+
+    # On 401 refresh the token once and replay the request
+    if response.status_code == 401 and managed:
+        token = refresh_token(core_address, headers["Authorization"][len("Bearer "):])
+        headers = {**headers, "Authorization": "Bearer " + token["access_token"]}
+        response = send_request(method, url, headers=headers, data=data)
+
+    host = urllib.parse.urlsplit(url).hostname
+    metrics.inc(
+        "incsender_http_requests_total",
+        {"host": host, "status": response.status_code},
+    )
+
+    if (
+        response.ok
+        or (method == "POST" and response.status_code == 400)
+        or response.status_code in accept_status
+    ):
         return response
     else:
         raise Exception(
@@ -206,12 +2083,11 @@ def make_request(method, url, headers=None, data=None):
         )
 
 
-def obtain_token(core_address, login, password, client_secret):
-    global mpToken
+def request_token(core_address, login, password, client_secret, refresh_token=None):
+    headers = {"Content-Type": "application/x-www-form-urlencoded"}
 
-    if mpToken is None:
+    if refresh_token is None:
         # Make a token request
-        headers = {"Content-Type": "application/x-www-form-urlencoded"}
         payload = {
             "grant_type": "password",
             "client_id": "mpx",
@@ -224,65 +2100,116 @@ def obtain_token(core_address, login, password, client_secret):
         logging.info(
             f"Making token request to https://{core_address}:3334/connect/token"
         )
+    else:
+        # Refresh the token
+        payload = {
+            "grant_type": "refresh_token",
+            "client_id": "mpx",
+            "client_secret": client_secret,
+            "scope": "offline_access mpx.api ptkb.api",
+            "refresh_token": refresh_token,
+            "username": login,
+            "password": password,
+        }
+        logging.info(f"Refreshing token https://{core_address}:3334/connect/token")
 
-        response = make_request(
-            "POST",
-            f"https://{core_address}:3334/connect/token",
-            headers=headers,
-            data=payload,
-        )
+    response = make_request(
+        "POST",
+        f"https://{core_address}:3334/connect/token",
+        headers=headers,
+        data=payload,
+    )
 
-        # Process the response
-        response_data = json.loads(response.text)
-        response_data["obtain_time"] = datetime.datetime.now().isoformat()
+    # Process the response
+    response_data = json.loads(response.text)
+    if "access_token" not in response_data:
+        raise Exception(f"Token request to {core_address} failed: {response.text}")
 
-        mpToken = response_data
+    response_data["obtain_time"] = datetime.datetime.now().isoformat()
+
+    return response_data
+
+
+def token_refresh_time(token):
+    # Token is refreshed ahead of expires_in, 12 hours if core did not
+    # return it
+    obtain_time = datetime.datetime.strptime(
+        token["obtain_time"], "%Y-%m-%dT%H:%M:%S.%f"
+    )
+    expires_in = token.get("expires_in")
+
+    if not expires_in:
+        return obtain_time + datetime.timedelta(hours=12)
+
+    return obtain_time + datetime.timedelta(
+        seconds=expires_in - max(60, expires_in * 0.2)
+    )
+
+
+def refresh_token(core_address, stale_token=None):
+    # Only one refresh per core at a time, threads waiting for the lock
+    # get the token refreshed by the first one
+    with tokenLocks[core_address]:
+        token = mpTokens.get(core_address)
+        if token is not None and token["access_token"] != stale_token:
+            return token
+
+        login, password, client_secret = tokenCredentials[core_address]
+
+        new_token = None
+        if token is not None and token.get("refresh_token"):
+            try:
+                new_token = request_token(
+                    core_address,
+                    login,
+                    password,
+                    client_secret,
+                    token["refresh_token"],
+                )
+                logging.info("Token refreshed")
+            except Exception as e:
+                logging.error(f"Error on token refresh: {e}.")
+
+        if new_token is None:
+            new_token = request_token(core_address, login, password, client_secret)
+            logging.info("Token fetched")
+
+        mpTokens[core_address] = new_token
+
+        return new_token
+
+
+def obtain_token(core_address, login, password, client_secret):
+    # Every MP10 core has its own token
+    tokenCredentials[core_address] = (login, password, client_secret)
+    token = mpTokens.get(core_address)
 
-        logging.info("Token fetched")
+    if token is None:
+        return refresh_token(core_address)
 
-        return mpToken
-    else:
-        # Check if the token needs to be refreshed
-        if (
-            datetime.datetime.now()
-            - datetime.datetime.strptime(mpToken["obtain_time"], "%Y-%m-%dT%H:%M:%S.%f")
-        ) > datetime.timedelta(hours=12):
-            # Refresh the token
-            headers = {"Content-Type": "application/x-www-form-urlencoded"}
-            payload = {
-                "grant_type": "refresh_token",
-                "client_id": "mpx",
-                "client_secret": client_secret,
-                "scope": "offline_access mpx.api ptkb.api",
-                "refresh_token": mpToken["refresh_token"],
-                "username": login,
-                "password": password,
-            }
-            logging.info(f"Refreshing token https://{core_address}:3334/connect/token")
+    if datetime.datetime.now() >= token_refresh_time(token):
+        return refresh_token(core_address, token["access_token"])
 
-            response = make_request(
-                "POST",
-                f"https://{core_address}:3334/connect/token",
-                headers=headers,
-                data=payload,
-            )
+    # Token is still valid
+    logging.info("Token already obtained and valid")
+    return token
 
-            # Process the response
-            response_data = json.loads(response.text)
-            response_data["obtain_time"] = datetime.datetime.now().isoformat()
 
-            mpToken = response_data
+def parse_incidents_response(response):
+    # Incidents query is POST, make_request passes 400 through
+    if response.status_code == 400:
+        raise Exception(f"Incidents query rejected with 400 - {response.text}")
 
-            logging.info("Token refreshed")
+    body = json.loads(response.text)
+    if "incidents" not in body:
+        raise Exception(f"Incidents query returned no incidents list - {response.text}")
 
-            return response_data
-        else:
-            # Token is still valid
-            logging.info("Token already obtained and valid")
-            return mpToken
+    return body["incidents"]
 
 
-def get_incidents(access_token, core_address, savepoint):
+def get_incidents(
+    access_token, core_address, savepoint, page_size=50, where='(status != "Closed")'
+):
     # Set the headers for the API request
     headers = {
         "Content-Type": "application/json",
@@ -292,7 +2219,7 @@ def get_incidents(access_token, core_address, savepoint):
     # Set the payload for the API request
     payload = {
         "offset": 0,
-        "limit": 50,
+        "limit": page_size,
         "groups": {"filterType": "no_filter"},
         "timeFrom": savepoint.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
         "timeTo": None,
@@ -307,13 +2234,79 @@ def get_incidents(access_token, core_address, savepoint):
                 "created",
                 "assigned",
             ],
-            "where": '(status != "Closed")',
+            "where": where,
             "orderby": [{"field": "created", "sortOrder": "ascending"}],
         },
         "queryIds": ["all_incidents"],
     }
 
-    # Make the API request
+    # Walk pages by creation time of the last returned incident until a short
+    # page is returned. Offset paging skips incidents when earlier ones are
+    # closed while the batch is sent, repeats of the last second are dropped
+    returned = set()
+
+    while True:
+        with metrics.timer("incsender_stage_duration_seconds", {"stage": "fetch"}):
+            response = make_request(
+                "POST",
+                f"https://{core_address}/api/v2/incidents",
+                headers=headers,
+                data=json.dumps(payload),
+            )
+
+            page = parse_incidents_response(response)
+
+        incidents = [incident for incident in page if incident["id"] not in returned]
+        metrics.inc(
+            "incsender_incidents_fetched_total", {"target": core_address}, len(incidents)
+        )
+        logging.info(
+            f"Fetched {len(incidents)} incidents from {payload['timeFrom']} at offset {payload['offset']}"
+        )
+
+        fetched = time.time()
+        for incident in incidents:
+            incident["fetched_at"] = fetched
+
+        returned.update(incident["id"] for incident in incidents)
+
+        yield from incidents
+
+        if len(page) < page_size:
+            break
+
+        # Offset is used only inside one second with more than a page of
+        # incidents
+        time_from = parse_created(page[-1]["created"]).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+        if time_from == payload["timeFrom"]:
+            payload["offset"] += page_size
+        else:
+            payload["timeFrom"] = time_from
+            payload["offset"] = 0
+
+
+def probe_incidents(access_token, core_address, savepoint, where):
+    # Cheap query for the newest incident only
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": "Bearer " + access_token,
+    }
+
+    payload = {
+        "offset": 0,
+        "limit": 1,
+        "groups": {"filterType": "no_filter"},
+        "timeFrom": savepoint.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+        "timeTo": None,
+        "filterTimeType": "creation",
+        "filter": {
+            "select": ["key", "created"],
+            "where": where,
+            "orderby": [{"field": "created", "sortOrder": "descending"}],
+        },
+        "queryIds": ["all_incidents"],
+    }
+
     response = make_request(
         "POST",
         f"https://{core_address}/api/v2/incidents",
@@ -321,10 +2314,12 @@ def get_incidents(access_token, core_address, savepoint):
         data=json.dumps(payload),
     )
 
-    return json.loads(response.text)
+    incidents = parse_incidents_response(response)
+
+    return incidents[0] if incidents else None
 
 
-def get_table_blacklist(access_token, core_address, table_list_name):
+def get_table_list_token(access_token, core_address, table_list_name):
     # Set the headers for the API request
     headers = {
         "Content-Type": "application/json",
@@ -339,16 +2334,24 @@ def get_table_blacklist(access_token, core_address, table_list_name):
         ).text
     )
 
-    filter_list_token = [
+    return [
         table_list["token"]
         for table_list in table_lists
         if table_list["name"] == table_list_name
     ][0]
 
+
+def search_table_list(access_token, core_address, filter_list_token, offset, limit):
+    # Set the headers for the API request
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": "Bearer " + access_token,
+    }
+
     # Set the payload for the API request
     payload = {
-        "offset": 0,
-        "limit": 100,
+        "offset": offset,
+        "limit": limit,
         "filter": {
             "select": ["_last_changed", "name"],
             "where": "",
@@ -368,6 +2371,128 @@ def get_table_blacklist(access_token, core_address, table_list_name):
     return json.loads(response.text)
 
 
+def table_list_marker(page):
+    # Latest _last_changed and rows count of the table list, read from a
+    # page sorted by _last_changed
+    items = page.get("items", [])
+
+    return [items[0].get("_last_changed") if items else None, page.get("totalCount")]
+
+
+def get_table_blacklist(access_token, core_address, table_list_name, page_size=1000):
+    # Table list names are cached across runs and refreshed only when the
+    # latest _last_changed (or the rows count) of the table list moves. The
+    # one row probe is made only when there is a cached filter to check
+    cached = tableListCache.get((core_address, table_list_name))
+
+    if cached is not None:
+        try:
+            marker = table_list_marker(
+                search_table_list(access_token, core_address, cached["token"], 0, 1)
+            )
+        except Exception as e:
+            logging.info(f"Table list {table_list_name} probe failed: {e}")
+            cached = None
+
+    if cached is None:
+        filter_list_token = get_table_list_token(
+            access_token, core_address, table_list_name
+        )
+        marker = None
+    elif cached["marker"] == marker:
+        logging.info(f"Table list {table_list_name} not changed, using cached filter")
+        return cached["names"]
+    else:
+        filter_list_token = cached["token"]
+
+    # Read all pages of the table list
+    names = set()
+    offset = 0
+    while True:
+        page = search_table_list(
+            access_token, core_address, filter_list_token, offset, page_size
+        )
+        items = page.get("items", [])
+
+        if offset == 0 and marker is None:
+            marker = table_list_marker(page)
+
+        names.update(item["name"] for item in items)
+
+        if len(items) < page_size:
+            break
+
+        offset += page_size
+
+    tableListCache[(core_address, table_list_name)] = {
+        "token": filter_list_token,
+        "marker": marker,
+        "names": names,
+    }
+
+    logging.info(f"Table list {table_list_name} loaded: {len(names)} names")
+
+    return names
+
+
+class IncidentCache:
+    # Size-bounded LRU cache of incident data with TTL
+    def __init__(self, max_size=1000, ttl=600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+
+            stored, value = item
+            if time.monotonic() - stored > self.ttl:
+                del self.items[key]
+                return None
+
+            self.items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = (time.monotonic(), value)
+            self.items.move_to_end(key)
+
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+
+def get_incident_cache(max_size=1000, ttl=600):
+    global incidentCache
+
+    if incidentCache is None:
+        incidentCache = IncidentCache(max_size, ttl)
+
+    return incidentCache
+
+
+def incident_cache_key(core_address, incident):
+    # Incidents query does not return a modification time, so a changed
+    # incident is read again only after the cache TTL
+    return (core_address, incident["id"])
+
+
+def get_cached_incident_data(accessToken, core_address, incident):
+    cache = get_incident_cache()
+    key = incident_cache_key(core_address, incident)
+
+    incident_data = cache.get(key)
+    if incident_data is None:
+        incident_data = get_incident_data(accessToken, core_address, incident["id"])
+        cache.put(key, incident_data)
+
+    return incident_data
+
+
 def get_incident_data(accessToken, core_address, id):
     # Set the headers for the request
     headers = {
@@ -385,44 +2510,244 @@ def get_incident_data(accessToken, core_address, id):
     return json.loads(response.text)
 
 
-def send_to_telegram(incidents, tg_token, chat_id, core_address, gmt):
-    # Iterate over incidents and send each one to Telegram
-    for incident in incidents["incidents"]:
-        # Create the message to send
-        message = (
-            f'<b>ID</b>: <a href="https://{core_address}/#/incident/incidents/view/{incident["id"]}">{incident["key"]}</a>\n'
-            f'<b>{incident["name"]}</b>\n'
-            f'{incident["description"]}\n\n'
-            f'<b>Опасность</b>: {incident["severity"]}\n'
-            f'<b>Создан</b>: {(datetime.datetime.strptime(incident["created"][:26], "%Y-%m-%dT%H:%M:%S.%f") + datetime.timedelta(hours=gmt)).strftime("%H:%M:%S %d.%m.%Y")}\n'
-            f'<a href="https://{core_address}/#/events/view?groupId=-1&incKey={incident["key"]}&incidentId={incident["id"]}&incidentName={incident["name"]}">Перейти к событиям</a>'
-        )
+# Output templates, filled with rendered incident view
+TELEGRAM_TEMPLATE = (
+    '<b>ID</b>: <a href="{incident_link}">{key}</a>\n'
+    "<b>{name}</b>\n"
+    "{description}\n\n"
+    "<b>Опасность</b>: {severity}\n"
+    "<b>Создан</b>: {created_local}\n"
+    '<a href="{events_link}">Перейти к событиям</a>'
+)
 
-        # Send the message to Telegram
-        data = {"chat_id": chat_id, "text": message, "parse_mode": "HTML"}
+MATTERMOST_TEMPLATE = (
+    "*ID*: [{key}]({incident_link})\n"
+    "*Имя*: {name}\n"
+    "*Опасность*: {severity}\n"
+    "*Создан*: {created_local}\n"
+    "*Описание*: {description}\n"
+    "[Перейти к событиям]({events_link})"
+)
 
-        make_request(
+MATTERMOST_DIGEST_HEADER = (
+    "**Новые инциденты: {count}**\n\n"
+    "| ID | Имя | Опасность | Создан |\n"
+    "| --- | --- | --- | --- |"
+)
+
+MATTERMOST_DIGEST_ROW = "| [{key}]({incident_link}) | {name} | {severity} | {created_local} |"
+
+# Mattermost post and Teams webhook payload size limits
+MATTERMOST_MESSAGE_LIMIT = 16383
+TEAMS_PAYLOAD_LIMIT = 28000
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+CEF_TEMPLATE = "<14>CEF:0|PT|SIEM|8.0|{name}|{severity}|{extension}"
+
+CEF_SHORT_EXTENSION_TEMPLATE = "description={description} link={link} time={time}"
+
+
+class TokenBucket:
+    # Thread-safe token bucket, acquire blocks until a token is available
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+def get_telegram_bucket(key, rate, capacity):
+    if key not in telegramBuckets:
+        telegramBuckets[key] = TokenBucket(rate, capacity)
+
+    return telegramBuckets[key]
+
+
+class TelegramRejected(Exception):
+    pass
+
+
+def send_telegram_message(tg_token, chat_id, message, bot_rate=30, chat_rate=20):
+    # Telegram limits: about 30 messages per second for a bot and 20 messages
+    # per minute for a group chat, on 429 wait for retry_after and resend
+    bot_bucket = get_telegram_bucket(("bot", tg_token), bot_rate, bot_rate)
+    chat_bucket = get_telegram_bucket(
+        ("chat", tg_token, chat_id), chat_rate / 60, max(chat_rate // 3, 1)
+    )
+    data = {"chat_id": chat_id, "text": message, "parse_mode": "HTML"}
+
+    for _ in range(5):
+        chat_bucket.acquire()
+        bot_bucket.acquire()
+
+        response = make_request(
             "POST",
             f"https://api.telegram.org/bot{tg_token}/sendMessage",
             headers=None,
             data=data,
+            accept_status=(429,),
+        )
+
+        if response.status_code != 429:
+            if response.status_code == 400 or json.loads(response.text).get("ok") is False:
+                raise TelegramRejected(
+                    f"Telegram rejected message for chat {chat_id} with {response.status_code} - {response.text}"
+                )
+            return
+
+        retry_after = (
+            json.loads(response.text).get("parameters", {}).get("retry_after", 1)
+        )
+        logging.info(f"Telegram rate limit hit, retry after {retry_after}s")
+
+        chat_bucket.pause(retry_after)
+
+    raise Exception(f"Telegram rate limit exceeded for chat {chat_id}")
+
+
+def render_telegram_message(incident, limit=TELEGRAM_MESSAGE_LIMIT):
+    # Fill the HTML template with escaped fields, the description is cut to
+    # keep the message under the Telegram length limit
+    fields = {
+        key: html.escape(value) if isinstance(value, str) else value
+        for key, value in incident.items()
+    }
+    description = str(incident.get("description", ""))
+    message = TELEGRAM_TEMPLATE.format_map(fields)
+    while len(message) > limit and description:
+        description = description[: max(len(description) - (len(message) - limit) - 1, 0)]
+        fields["description"] = html.escape(description) + "…"
+        message = TELEGRAM_TEMPLATE.format_map(fields)
+
+    return message
+
+
+def merge_telegram_messages(messages, limit=TELEGRAM_MESSAGE_LIMIT):
+    # Group messages into as few as possible under the Telegram length limit,
+    # messages of a group are joined with an empty line
+    return split_by_size(messages, [len(message) + 2 for message in messages], limit + 2)
+
+
+def send_to_telegram(incidents, tg_token, chat_id, merge_threshold=20, chat_rate=20):
+    # Create the messages to send
+    messages = [render_telegram_message(incident) for incident in incidents["incidents"]]
+
+    # Merge several incidents into one message when backlog is large
+    if len(messages) > merge_threshold:
+        groups = merge_telegram_messages(messages)
+        logging.info(
+            f"{len(incidents['incidents'])} incidents merged into {len(groups)} Telegram messages"
         )
+    else:
+        groups = [[message] for message in messages]
+
+    # Send the messages to Telegram, merged message rejected by Telegram is
+    # sent again as one message per incident
+    for group in groups:
+        try:
+            send_telegram_message(
+                tg_token, chat_id, "\n\n".join(group), chat_rate=chat_rate
+            )
+        except TelegramRejected:
+            if len(group) == 1:
+                raise
+            logging.info(
+                f"Merged Telegram message rejected, sending {len(group)} incidents one by one"
+            )
+            for message in group:
+                send_telegram_message(tg_token, chat_id, message, chat_rate=chat_rate)
 
+    for incident in incidents["incidents"]:
         logging.info(f"{incident['key']} sended to Telegram successfully")
 
 
-def send_to_mattermost(incidents, mm_webhook_url, core_address, gmt, mm_username):
+def split_by_size(items, sizes, limit, overhead=0):
+    # Group items in order, so sizes of every group fit into the limit. Item
+    # larger than the limit makes a group of its own
+    groups = []
+    size = limit
+    for item, item_size in zip(items, sizes):
+        if not groups or size + item_size > limit:
+            groups.append([])
+            size = overhead
+        groups[-1].append(item)
+        size += item_size
+
+    return groups
+
+
+def escape_markdown_cell(value):
+    return str(value).replace("|", "\\|").replace("\r", " ").replace("\n", " ")
+
+
+def build_mattermost_digests(incidents, limit=MATTERMOST_MESSAGE_LIMIT):
+    # Markdown table of incidents split into posts under the size limit
+    rows = [
+        MATTERMOST_DIGEST_ROW.format_map(
+            {
+                **incident,
+                "name": escape_markdown_cell(incident["name"]),
+                "severity": escape_markdown_cell(incident["severity"]),
+            }
+        )
+        for incident in incidents
+    ]
+    header_size = len(MATTERMOST_DIGEST_HEADER.format(count=len(incidents)))
+
+    return [
+        "\n".join([MATTERMOST_DIGEST_HEADER.format(count=len(group)), *group])
+        for group in split_by_size(
+            rows, [len(row) + 1 for row in rows], limit, header_size
+        )
+    ]
+
+
+def send_to_mattermost(incidents, mm_webhook_url, mm_username, digest_threshold=0):
+    # Send one digest table instead of a post per incident when batch is large
+    if digest_threshold and len(incidents["incidents"]) > digest_threshold:
+        digests = build_mattermost_digests(incidents["incidents"])
+        for digest in digests:
+            data = {"username": mm_username, "text": digest}
+
+            make_request("POST", mm_webhook_url, headers=None, data=json.dumps(data))
+
+        logging.info(
+            f"{len(incidents['incidents'])} incidents sent to Mattermost in {len(digests)} digests"
+        )
+        for incident in incidents["incidents"]:
+            logging.info(f"{incident['key']} sended to Mattermost successfully")
+
+        return
+
     # Iterate over incidents and send each one to Mattermost
     for incident in incidents["incidents"]:
         # Create the message to send
-        message = (
-            f"*ID*: [{incident['key']}](https://{core_address}/#/incident/incidents/view/{incident['id']})\n"
-            f"*Имя*: {incident['name']}\n"
-            f"*Опасность*: {incident['severity']}\n"
-            f"*Создан*: {(datetime.datetime.strptime(incident['created'][:26], '%Y-%m-%dT%H:%M:%S.%f') + datetime.timedelta(hours=gmt)).strftime('%H:%M:%S %d.%m.%Y')}\n"
-            f"*Описание*: {incident['description']}\n"
-            f"[Перейти к событиям](https://{core_address}/#/events/view?groupId=-1&incKey={incident['key']}&incidentId={incident['id']}&incidentName={incident['name']})"
-        )
+        message = MATTERMOST_TEMPLATE.format_map(incident)
 
         # Send the message to Mattermost
         data = {"username": mm_username, "text": message}
@@ -432,120 +2757,347 @@ def send_to_mattermost(incidents, mm_webhook_url, core_address, gmt, mm_username
         logging.info(f"{incident['key']} sended to Mattermost successfully")
 
 
-def send_to_teams(incidents, teams_webhook_url, core_address, gmt):
-    # Iterate over incidents and send each one to MS Teams
-    for incident in incidents["incidents"]:
-        # Build Adaptive Card for Teams message
-        card = {
-            "$schema": "http://adaptivecards.io/schemas/adaptive-card.json",
-            "type": "AdaptiveCard",
-            "version": "1.4",
-            "body": [
-                {
-                    "type": "TextBlock",
-                    "text": f'{incident["name"]}',
-                    "weight": "Bolder",
-                    "size": "Large",
-                },
-                {
-                    "type": "TextBlock",
-                    "text": incident["description"],
-                    "weight": "Bolder",
-                    "size": "Medium",
-                    "wrap": True,
-                },
+def build_teams_card(incident):
+    # Build Adaptive Card for Teams message
+    return {
+        "$schema": "http://adaptivecards.io/schemas/adaptive-card.json",
+        "type": "AdaptiveCard",
+        "version": "1.4",
+        "body": [
+            {
+                "type": "TextBlock",
+                "text": incident["name"],
+                "weight": "Bolder",
+                "size": "Large",
+            },
+            {
+                "type": "TextBlock",
+                "text": incident["description"],
+                "weight": "Bolder",
+                "size": "Medium",
+                "wrap": True,
+            },
+            {
+                "type": "FactSet",
+                "facts": [
+                    {
+                        "title": "ID",
+                        "value": f"[{incident['key']}]({incident['incident_link']})",
+                    },
+                    {"title": "Важность", "value": incident["severity"]},
+                    {"title": "Создан", "value": incident["created_local"]},
+                ],
+            },
+        ],
+    }
+
+
+def build_teams_digest_section(incident):
+    # Incident name with its facts, repeated in the digest card
+    return [
+        {
+            "type": "TextBlock",
+            "text": incident["name"],
+            "weight": "Bolder",
+            "wrap": True,
+            "separator": True,
+        },
+        {
+            "type": "FactSet",
+            "facts": [
                 {
-                    "type": "FactSet",
-                    "facts": [
-                        {
-                            "title": "ID",
-                            "value": f"[{incident['key']}](https://{core_address}/#/incident/incidents/view/{incident['id']})",
-                        },
-                        {"title": "Важность", "value": incident["severity"]},
-                        {
-                            "title": "Создан",
-                            "value": (
-                                datetime.datetime.strptime(
-                                    incident["created"][:26], "%Y-%m-%dT%H:%M:%S.%f"
-                                )
-                                + datetime.timedelta(hours=gmt)
-                            ).strftime("%H:%M:%S %d.%m.%Y"),
-                        },
-                    ],
+                    "title": "ID",
+                    "value": f"[{incident['key']}]({incident['incident_link']})",
                 },
+                {"title": "Важность", "value": incident["severity"]},
+                {"title": "Создан", "value": incident["created_local"]},
             ],
-        }
+        },
+    ]
 
-        # Send the message to MS Teams
-        data = {
-            "type": "message",
-            "attachments": [
-                {
-                    "contentType": "application/vnd.microsoft.card.adaptive",
-                    "content": card,
-                }
-            ],
-        }
 
-        make_request("POST", teams_webhook_url, headers=None, data=json.dumps(data))
+def build_teams_digest_cards(incidents, limit=TEAMS_PAYLOAD_LIMIT):
+    # Adaptive Cards with a section per incident split under the payload limit
+    sections = [build_teams_digest_section(incident) for incident in incidents]
+    overhead = len(
+        json.dumps(build_teams_message(build_teams_digest_card(len(incidents), [])))
+    )
+
+    return [
+        build_teams_digest_card(
+            len(group), [element for section in group for element in section]
+        )
+        for group in split_by_size(
+            sections,
+            [len(json.dumps(section)) for section in sections],
+            limit,
+            overhead,
+        )
+    ]
+
+
+def build_teams_digest_card(count, body):
+    return {
+        "$schema": "http://adaptivecards.io/schemas/adaptive-card.json",
+        "type": "AdaptiveCard",
+        "version": "1.4",
+        "body": [
+            {
+                "type": "TextBlock",
+                "text": f"Новые инциденты: {count}",
+                "weight": "Bolder",
+                "size": "Large",
+            },
+            *body,
+        ],
+    }
+
+
+def build_teams_message(card):
+    return {
+        "type": "message",
+        "attachments": [
+            {
+                "contentType": "application/vnd.microsoft.card.adaptive",
+                "content": card,
+            }
+        ],
+    }
+
+
+def send_to_teams(incidents, teams_webhook_url, digest_threshold=0):
+    # Send one digest card instead of a card per incident when batch is large
+    if digest_threshold and len(incidents["incidents"]) > digest_threshold:
+        cards = build_teams_digest_cards(incidents["incidents"])
+        for card in cards:
+            make_request(
+                "POST",
+                teams_webhook_url,
+                headers=None,
+                data=json.dumps(build_teams_message(card)),
+            )
+
+        logging.info(
+            f"{len(incidents['incidents'])} incidents sent to MS Teams in {len(cards)} digests"
+        )
+        for incident in incidents["incidents"]:
+            logging.info(f"{incident['key']} sended to MS Teams successfully")
+
+        return
+
+    # Iterate over incidents and send each one to MS Teams
+    for incident in incidents["incidents"]:
+        card = build_teams_card(incident)
+
+        # Send the message to MS Teams
+        make_request(
+            "POST",
+            teams_webhook_url,
+            headers=None,
+            data=json.dumps(build_teams_message(card)),
+        )
 
         logging.info(f"{incident['key']} sended to MS Teams successfully")
 
 
-def send_to_syslog(incidents, gmt, syslog_server, core_address, protocol, port, isFullBody):
-    # Create a socket for sending messages
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM if protocol.lower() == "tcp" else socket.SOCK_DGRAM)
+class SyslogConnection:
+    # Long-lived syslog connection, TCP messages are framed with newline
+    # or octet counting (RFC 6587) and written in large buffers
+    def __init__(self, server, port, protocol, framing="lf", use_tls=False, tls_verify=True):
+        self.server = server
+        self.port = port
+        self.protocol = protocol.lower()
+        self.framing = framing.lower()
+        self.use_tls = use_tls
+        self.tls_verify = tls_verify
+        self.sock = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.protocol == "tcp":
+            sock = socket.create_connection((self.server, self.port), timeout=30)
+            if self.use_tls:
+                context = ssl.create_default_context()
+                if not self.tls_verify:
+                    context.check_hostname = False
+                    context.verify_mode = ssl.CERT_NONE
+                sock = context.wrap_socket(sock, server_hostname=self.server)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.connect((self.server, self.port))
+
+        self.sock = sock
+        logging.info(f"Connected to syslog server {self.server}:{self.port}")
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+    def frame(self, message):
+        data = message.encode("utf-8")
+        if self.framing == "octet":
+            return f"{len(data)} ".encode("ascii") + data
+        return data + b"\n"
+
+    def write(self, messages, batch_bytes):
+        if self.protocol != "tcp":
+            # Every UDP datagram is a single message
+            for message in messages:
+                self.sock.send(message.encode("utf-8"))
+            return
+
+        buffer = bytearray()
+        for message in messages:
+            buffer += self.frame(message)
+            if len(buffer) >= batch_bytes:
+                self.sock.sendall(buffer)
+                buffer.clear()
+
+        if buffer:
+            self.sock.sendall(buffer)
+
+    def send(self, messages, batch_bytes=65536, attempts=5):
+        # Reconnect with exponential backoff and resend the whole batch
+        with self.lock:
+            for attempt in range(attempts):
+                try:
+                    if self.sock is None:
+                        self.connect()
+                    self.write(messages, batch_bytes)
+                    return
+                except OSError as e:
+                    self.close()
+                    if attempt == attempts - 1:
+                        raise
+                    delay = min(2**attempt, 30)
+                    logging.error(
+                        f"Error while sending to syslog server: {e}, reconnect in {delay}s"
+                    )
+                    time.sleep(delay)
+
+
+def get_syslog_connection(server, port, protocol, framing="lf", use_tls=False, tls_verify=True):
+    key = (server, port, protocol.lower(), framing.lower(), use_tls, tls_verify)
+
+    if key not in syslogConnections:
+        syslogConnections[key] = SyslogConnection(
+            server, port, protocol, framing, use_tls, tls_verify
+        )
+
+    return syslogConnections[key]
 
-    # Connect to the syslog server
-    sock.connect((syslog_server, port))
 
-    # Iterate over incidents and send each one to the syslog server
+def send_to_syslog(
+    incidents,
+    syslog_server,
+    protocol,
+    port,
+    isFullBody,
+    framing="lf",
+    use_tls=False,
+    tls_verify=True,
+    include=None,
+    exclude=None,
+):
+    messages = []
+    keys = []
+
     if isFullBody:
         for incident in incidents:
             # Format the incident data in CEF (or like CEF) format
-            full_body_kv = convert_json_to_plain_text(json.loads(incident))
-            inc = json.loads(incident)
-            message = f"<14>CEF:0|PT|SIEM|8.0|{inc['name']}|{inc['severity']}|{full_body_kv}\n"
-
-            # Send the message to the syslog server
-            sock.send(message.encode("utf-8"))
-            
-            logging.info(f"Incident {inc['key']} sent to syslog server successfully")
+            full_body_kv = convert_json_to_plain_text(incident, include, exclude)
+            messages.append(
+                CEF_TEMPLATE.format(
+                    name=escape_cef_header(incident["name"]),
+                    severity=escape_cef_header(incident["severity"]),
+                    extension=full_body_kv,
+                )
+            )
+            keys.append(incident["key"])
     else:
         for incident in incidents["incidents"]:
-            link = f"https://{core_address}/#/incident/incidents/view/{incident['id']}"
+            messages.append(
+                CEF_TEMPLATE.format(
+                    name=escape_cef_header(incident["name"]),
+                    severity=escape_cef_header(incident["severity"]),
+                    extension=CEF_SHORT_EXTENSION_TEMPLATE.format(
+                        description=escape_cef_value(incident["description"]),
+                        link=escape_cef_value(incident["incident_link"]),
+                        time=incident["created_local"],
+                    ),
+                )
+            )
+            keys.append(incident["key"])
 
-            message = f"<14>CEF:0|PT|SIEM|8.0|{incident['name']}|{incident['severity']}|description={incident['description']} link={link} time={(datetime.datetime.strptime(incident['created'][:26], '%Y-%m-%dT%H:%M:%S.%f') + datetime.timedelta(hours=gmt)).strftime('%H:%M:%S %d.%m.%Y')}\n"
+    # Send the messages to the syslog server over the shared connection
+    get_syslog_connection(
+        syslog_server, port, protocol, framing, use_tls, tls_verify
+    ).send(messages)
 
-            # Send the message to the syslog server
-            sock.send(message.encode("utf-8"))
-            
-            logging.info(f"Incident {incident['key']} sent to syslog server successfully")
+    for key in keys:
+        logging.info(f"Incident {key} sent to syslog server successfully")
+
+
+CEF_VALUE_ESCAPES = str.maketrans({"\\": "\\\\", "=": "\\=", "\n": "\\n", "\r": "\\r"})
+CEF_HEADER_ESCAPES = str.maketrans({"\\": "\\\\", "|": "\\|", "\n": " ", "\r": " "})
+
+
+def escape_cef_value(value):
+    return str(value).translate(CEF_VALUE_ESCAPES)
+
+
+def escape_cef_header(value):
+    return str(value).translate(CEF_HEADER_ESCAPES)
+
+
+def parse_fields(fields):
+    # Comma-separated list of fields, e.g. "name,severity,assets"
+    return [field.strip() for field in fields.split(",") if field.strip()] or None
+
+
+def match_field(path, fields):
+    return any(
+        path == field or path.startswith(f"{field}.") or path.startswith(f"{field}[")
+        for field in fields
+    )
+
+
+def convert_json_to_plain_text(data, include=None, exclude=None):
+    # Flatten data into CEF extension key=value pairs in one pass, nested
+    # keys are joined with dots and list items are indexed
+    parts = []
+
+    def flatten(value, prefix):
+        if prefix and exclude and match_field(prefix, exclude):
+            return
+
+        if isinstance(value, dict):
+            for key, item in value.items():
+                flatten(item, f"{prefix}.{key}" if prefix else str(key))
+        elif isinstance(value, list):
+            for index, item in enumerate(value):
+                flatten(item, f"{prefix}[{index}]")
+        elif include is None or match_field(prefix, include):
+            parts.append(f"{prefix}={escape_cef_value(value)}")
+
+    flatten(data, "")
+
+    return " ".join(parts)
 
-    # Close the socket connection
-    sock.close()
 
-def convert_json_to_plain_text(data, prefix=""):
-    plain_text = ""
-    if isinstance(data, dict):
-        for key, value in data.items():
-            if prefix:
-                new_prefix = f"{prefix}.{key}"
-            else:
-                new_prefix = key
-            plain_text += convert_json_to_plain_text(value, new_prefix) + " "
-    elif isinstance(data, list):
-        for index, value in enumerate(data):
-            new_prefix = f"{prefix}[{index}]"
-            plain_text += convert_json_to_plain_text(value, new_prefix) + " "
-    else:
-        plain_text = f"{prefix}={data}"
-    return plain_text.strip()
-    
 if __name__ == "__main__":
-    target = os.getenv('MP10_ADDRESS', '')
+    targets = [target.strip() for target in os.getenv('MP10_ADDRESS', '').split(',') if target.strip()]
+    targets_settings = json.loads(os.getenv('TARGETS_SETTINGS', '') or '{}')
     settings = dict(
      schedule = os.environ.get('SCHEDULE', '5'),
+     schedule_min_seconds=int(os.getenv('SCHEDULE_MIN_SECONDS', '30')),
+     schedule_max_seconds=int(os.getenv('SCHEDULE_MAX_SECONDS', '0')),
+     realtime_enabled=os.getenv('REALTIME_ENABLED', 'False').lower() == 'true',
+     realtime_interval=int(os.getenv('REALTIME_INTERVAL', '5')),
      minutes=int(os.getenv('MINUTES', '10')),
      gmt=int(os.getenv('GMT', '3')),
      filter_type=os.getenv('FILTER_TYPE', ''),
@@ -553,6 +3105,8 @@ if __name__ == "__main__":
      tg_enabled=bool(os.getenv('TG_ENABLED', 'False')),
      chat_id=os.getenv('CHAT_ID', ''),
      tg_token=os.getenv('TG_TOKEN', ''),
+     tg_merge_threshold=int(os.getenv('TG_MERGE_THRESHOLD', '20')),
+     tg_chat_rate=int(os.getenv('TG_CHAT_RATE', '20')),
      mm_enabled=bool(os.getenv('MM_ENABLED', 'False')),
      mm_username=os.getenv('MM_USERNAME', ''),
      mm_webhook_url=os.getenv('MM_WEBHOOK_URL', ''),
@@ -563,7 +3117,46 @@ if __name__ == "__main__":
      syslog_server=os.getenv('SYSLOG_SERVER', ''),
      syslog_proto=os.getenv('SYSLOG_PROTO', 'tcp'),
      syslog_port=int(os.getenv('SYSLOG_PORT', '1468')),
+     syslog_framing=os.getenv('SYSLOG_FRAMING', 'lf'),
+     syslog_tls=os.getenv('SYSLOG_TLS', 'False').lower() == 'true',
+     syslog_tls_verify=os.getenv('SYSLOG_TLS_VERIFY', 'True').lower() == 'true',
+     syslog_fields_include=os.getenv('SYSLOG_FIELDS_INCLUDE', ''),
+     syslog_fields_exclude=os.getenv('SYSLOG_FIELDS_EXCLUDE', ''),
+     page_size=int(os.getenv('PAGE_SIZE', '50')),
+     overlap_seconds=int(os.getenv('OVERLAP_SECONDS', '60')),
+     seen_ids_max=int(os.getenv('SEEN_IDS_MAX', '5000')),
+     state_path=os.getenv('STATE_PATH', './state.json'),
+     http_pool_connections=int(os.getenv('HTTP_POOL_CONNECTIONS', '10')),
+     http_pool_maxsize=int(os.getenv('HTTP_POOL_MAXSIZE', '10')),
+     enrich_workers=int(os.getenv('ENRICH_WORKERS', '4')),
+     incident_cache_size=int(os.getenv('INCIDENT_CACHE_SIZE', '1000')),
+     incident_cache_ttl=int(os.getenv('INCIDENT_CACHE_TTL', '600')),
+     filter_chunk_size=int(os.getenv('FILTER_CHUNK_SIZE', '100')),
+     sink_workers=int(os.getenv('SINK_WORKERS', '1')),
+     sink_queue_size=int(os.getenv('SINK_QUEUE_SIZE', '4')),
+     spool_path=os.getenv('SPOOL_PATH', './spool.db'),
+     metrics_port=int(os.getenv('METRICS_PORT', '0')),
+     engine=os.getenv('ENGINE', 'threads').lower(),
+     async_inflight=int(os.getenv('ASYNC_INFLIGHT', '100')),
+     async_queue_size=int(os.getenv('ASYNC_QUEUE_SIZE', '4')),
+     delivery_processes=int(os.getenv('DELIVERY_PROCESSES', '0')),
+     delivery_process_sinks=os.getenv('DELIVERY_PROCESS_SINKS', 'syslog,teams'),
+     delivery_queue_size=int(os.getenv('DELIVERY_QUEUE_SIZE', '0')),
+     cycle_budget_seconds=float(os.getenv('CYCLE_BUDGET_SECONDS', '0')),
+     circuit_failure_threshold=int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5')),
+     circuit_reset_seconds=float(os.getenv('CIRCUIT_RESET_SECONDS', '60')),
+     mm_digest_threshold=int(os.getenv('MM_DIGEST_THRESHOLD', '0')),
+     teams_digest_threshold=int(os.getenv('TEAMS_DIGEST_THRESHOLD', '0')),
+     latency_slo_seconds=float(os.getenv('LATENCY_SLO_SECONDS', '0')),
+     latency_window=int(os.getenv('LATENCY_WINDOW', '1000')),
      first_credential=dict(login=os.getenv('FIRST_CREDENTIAL_LOGIN', ''), password=os.getenv('FIRST_CREDENTIAL_PASSWORD', '')),
      second_credential=dict(password=os.getenv('SECOND_CREDENTIAL_PASSWORD', ''))
 )
-    run(target, settings)
+    if settings["metrics_port"]:
+        start_metrics_server(settings["metrics_port"])
+
+    if len(targets) > 1:
+        run_targets(targets, settings, targets_settings)
+    else:
+        target = targets[0] if targets else ''
+        run(target, {**settings, **targets_settings.get(target, {})})